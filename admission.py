@@ -0,0 +1,136 @@
+import asyncio
+import math
+import time
+
+from collections import deque
+from contextlib import asynccontextmanager
+
+from fastapi import Depends, HTTPException
+
+
+DEFAULT_LIMITS = {
+    "aggregation": {"limit": 8, "queue": 32, "wait": 10},
+    "paging": {"limit": 4, "queue": 16, "wait": 10},
+    "export": {"limit": 2, "queue": 4, "wait": 10},
+    "article": {"limit": 32, "queue": 128, "wait": 5}
+}
+
+
+class Overloaded(Exception):
+    """
+    Raised when a request cannot be admitted, with the HTTP status and a Retry-After estimate in seconds
+    """
+
+    def __init__(self, status: int, retry_after: int, reason: str):
+        super().__init__(reason)
+        self.status = status
+        self.retry_after = retry_after
+
+
+class Gate:
+    """
+    Concurrency limit with a bounded FIFO wait queue whose waiters give up after a deadline
+    """
+
+    def __init__(self, limit: int, queue: int, wait: float):
+        self.limit = limit
+        self.queue = queue
+        self.wait = wait
+        self.active = 0
+        self.waiters = deque()
+        self.service = 1.0
+        self.rejected = {429: 0, 503: 0}
+
+    def retry_after(self):
+        # Time for the requests ahead to drain, given the smoothed service time of a request
+        return max(1, math.ceil(self.service * (len(self.waiters) + 1) / self.limit))
+
+    async def acquire(self):
+        if self.active < self.limit and not self.waiters:
+            self.active += 1
+            return time.perf_counter()
+        if len(self.waiters) >= self.queue:
+            self.rejected[429] += 1
+            raise Overloaded(429, self.retry_after(), "Too many requests queued, retry later!")
+        fut = asyncio.get_running_loop().create_future()
+        self.waiters.append(fut)
+        try:
+            await asyncio.wait_for(fut, self.wait)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if fut.done() and not fut.cancelled():
+                # The slot was handed over just as the waiter gave up, so pass it on
+                self.release()
+            if isinstance(e, asyncio.CancelledError):
+                raise
+            self.rejected[503] += 1
+            raise Overloaded(503, self.retry_after(), "Service overloaded, retry later!") from e
+        finally:
+            if fut in self.waiters:
+                self.waiters.remove(fut)
+        return time.perf_counter()
+
+    def release(self, started: float = None):
+        if started is not None:
+            self.service = 0.8 * self.service + 0.2 * (time.perf_counter() - started)
+        while self.waiters:
+            fut = self.waiters.popleft()
+            if not fut.done():
+                fut.set_result(None)
+                return
+        self.active -= 1
+
+
+class AdmissionController:
+    """
+    Per collection and endpoint class gates, configured by class with optional "collection/class" overrides
+    """
+
+    def __init__(self, limits: dict, collections: list):
+        self.limits = limits
+        self.collections = set(collections)
+        self.gates = {}
+
+    def gate(self, collection: str, kind: str):
+        key = (collection, kind)
+        if key not in self.gates:
+            conf = {**DEFAULT_LIMITS[kind], **self.limits.get(kind, {}), **self.limits.get(f"{collection}/{kind}", {})}
+            self.gates[key] = Gate(int(conf["limit"]), int(conf["queue"]), float(conf["wait"]))
+        return self.gates[key]
+
+    def available(self, collection: str, kind: str):
+        """
+        Whether a slot of the collection gate is free without queueing, for work that is worth doing only when idle
+        """
+        if collection not in self.collections:
+            return True
+        gate = self.gate(collection, kind)
+        return gate.active < gate.limit and not gate.waiters
+
+    @asynccontextmanager
+    async def hold(self, collections: list, kind: str):
+        """
+        Hold a slot of the gate of each collection, taken in a fixed order so that concurrent holders never deadlock
+        """
+        held = []
+        try:
+            for collection in sorted(set(collections) & self.collections):
+                gate = self.gate(collection, kind)
+                try:
+                    held.append((gate, await gate.acquire()))
+                except Overloaded as e:
+                    raise HTTPException(status_code=e.status, detail=str(e),
+                                        headers={"retry-after": str(e.retry_after)}) from e
+            yield
+        finally:
+            for gate, started in reversed(held):
+                gate.release(started)
+
+    def dependencies(self, kind: str):
+        """
+        Route dependencies that hold a slot of the collection gate of an endpoint class while the request is served
+        """
+        async def slot(collection: str):
+            # Unknown collections are rejected by path validation, without creating a gate for them
+            async with self.hold([collection], kind):
+                yield
+        return [Depends(slot)]
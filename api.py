@@ -1,44 +1,66 @@
 #!/usr/bin/env python3
 
 
-import base64
+import asyncio
+import binascii
+import csv
+import io
+import json
 import os
 
+from collections import Counter
+from contextlib import asynccontextmanager
+from datetime import date
 from enum import Enum
-from typing import Union
+from typing import List, Union
 from urllib.parse import quote_plus
 
-from elasticsearch import Elasticsearch
+import msgpack
+import orjson
+
+from elasticsearch import AsyncElasticsearch
 from elasticsearch.exceptions import TransportError
-from fastapi import FastAPI, Request, Response, Body, HTTPException
+from fastapi import FastAPI, Request, Response, Body, HTTPException, Query as QueryParam
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import HTMLResponse, RedirectResponse
-from pydantic import BaseModel
-
-from utils import load_config, env_to_list, env_to_dict, list_to_enum
+from fastapi.responses import HTMLResponse, RedirectResponse, StreamingResponse
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
+
+from admission import AdmissionController
+from diagnostics import Profiler, TimingMiddleware
+from httpcache import HttpCache, DEFAULT_CACHE_CONTROL
+from metrics import MetricsMiddleware, formatting, register_admission, register_cache, timing
+from models import Collection, TermField, TermAggr, Interval, Facet, OverviewQuery, PagedQuery, ArticleIds
+from models import ExportFormat, ExportQuery, FederatedQuery, Query
+from queries import GUARD, FILTER_PATHS, cs_budget, cs_msearch, cs_overview_query, cs_paged_query, cs_search_params
+from queries import cs_terms_query, format_match, request_timeout, result_partial
+from partitions import PartitionCache
+from querycost import cost_headers
+from routing import es_options
+from settings import config
+
+from utils import encode, decode, normalize_query
+from utils import PrefetchBuffer, ResultCache
 
 
 class ApiVersion(str, Enum):
     v1 = "1.0.0"
 
 
-config = load_config()
-config["termfields"] = env_to_list("TERMFIELDS") or config.get("termfields", [])
-config["termaggrs"] = env_to_list("TERMAGGRS") or config.get("termaggrs", [])
-config["indexes"] = env_to_list("INDEXES") or config.get("indexes", [])
-config["eshosts"] = env_to_list("ESHOSTS") or config.get("eshosts", ["http://localhost:9200"])
-config["esopts"] = env_to_dict("ESOPTS") or config.get("esopts", {})
-config["wayback"] = os.getenv("WAYBACK", config.get("wayback", "https://web.archive.org/web")).rstrip("/")
-config["maxpage"] = int(os.getenv("MAXPAGE", config.get("maxpage", 1000)))
-config["title"] = os.getenv("TITLE", config.get("title", ""))
-config["description"] = os.getenv("DESCRIPTION", config.get("description", ""))
-config["debug"] = str(os.getenv("DEBUG", config.get("debug", False))).lower() in ("true", "1", "t")
+ES = AsyncElasticsearch(config["eshosts"], **es_options(config["routing"], config["espoolsize"], config["esopts"]))
+CACHE = ResultCache(config["cachesize"])
+register_cache(CACHE)
+PREFETCH = PrefetchBuffer(config["prefetchsize"], config["prefetchttl"])
+PARTITIONS = PartitionCache(ES, CACHE, config["partitions"], config["generationttl"])
+PROFILER = Profiler(config["profiling"])
 
-ES = Elasticsearch(config["eshosts"], **config["esopts"])
-
-Collection = list_to_enum("Collection", config["indexes"])
-TermField = list_to_enum("TermField", config["termfields"])
-TermAggr = list_to_enum("TermAggr", config["termaggrs"])
+ADMISSION = AdmissionController(config["admission"], [col.value for col in Collection])
+register_admission(ADMISSION)
+PAGING = ADMISSION.dependencies("paging")
+ARTICLE = ADMISSION.dependencies("article")
+EXPORT = ADMISSION.dependencies("export")
+HTTP_CACHE = HttpCache(ES, CACHE, config["generationttl"], {col.value: col.name for col in Collection},
+                       config["cachecontrol"])
+CACHED = {kind: HTTP_CACHE.dependencies(kind) for kind in DEFAULT_CACHE_CONTROL}
 
 tags = [{
     "name": "info",
@@ -54,8 +76,15 @@ if config["debug"]:
     })
 
 
+@asynccontextmanager
+async def lifespan(_: FastAPI):
+    yield
+    await ES.close()
+
+
 app = FastAPI(
     version=list(ApiVersion)[-1],
+    lifespan=lifespan,
     docs_url=None,
     redoc_url=None,
     openapi_url=None
@@ -66,7 +95,8 @@ app.add_middleware(
     allow_origins=["*"],  # nosemgrep: python.fastapi.security.wildcard-cors.wildcard-cors
     allow_methods=["GET", "HEAD", "POST", "OPTIONS"],
     allow_headers=["*"],
-    expose_headers=["link", "x-resume-token", "x-api-version"]
+    expose_headers=["link", "x-resume-token", "x-api-version", "x-partial-result", "x-query-cost", "x-query-action",
+                    "retry-after", "etag", "server-timing"]
 )
 
 @app.middleware("http")
@@ -76,6 +106,47 @@ async def add_api_version_header(req: Request, call_next):
     return res
 
 
+app.add_middleware(MetricsMiddleware, collections=[col.value for col in Collection])
+app.add_middleware(TimingMiddleware, profiler=PROFILER, servertiming=config["profiling"]["servertiming"])
+
+
+@app.get("/cache")
+def cache_stats():
+    """
+    Hit, miss and eviction counters of the query result cache
+    """
+    return CACHE.stats()
+
+
+@app.get("/metrics")
+def prometheus_metrics():
+    """
+    Request, ES and cache metrics in the Prometheus text format
+    """
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+
+if PROFILER.enabled:
+    @app.get("/profiles")
+    def list_profiles():
+        """
+        Sampled request profiles in the ring buffer, most recent first
+        """
+        return PROFILER.listing()
+
+    @app.get("/profiles/{pid}")
+    def download_profile(pid: int):
+        """
+        Download a profile as cProfile stats for pstats or snakeviz, or as folded stacks for flame graph tools
+        """
+        profile = PROFILER.get(pid)
+        if not profile:
+            raise HTTPException(status_code=404, detail="Profile not found!")
+        ext, mtype = ("prof", "application/octet-stream") if profile["kind"] == "cprofile" else ("folded", "text/plain")
+        headers = {"content-disposition": f'attachment; filename="profile-{pid}.{ext}"'}
+        return Response(profile["data"], media_type=mtype, headers=headers)
+
+
 v1 = FastAPI(
     title=config.get("title", "Interactive API") + " Docs",
     description=config.get("description", "A wrapper API for ES indexes."),
@@ -84,162 +155,148 @@ v1 = FastAPI(
 )
 
 
-class Query(BaseModel):
-    q: str
-
-
-class PagedQuery(Query):
-    resume: Union[str, None] = None
-
-
-def encode(strng: str):
-    return base64.b64encode(strng.encode(), b"-_").decode().replace("=", "~")
-
-
-def decode(strng: str):
-    return base64.b64decode(strng.replace("~", "=").encode(), b"-_").decode()
-
-
-def cs_basic_query(q: str):
-    return {
-        "_source": [
-            "title",
-            "publication_date",
-            "language",
-            "domain",
-            "url",
-            "first_captured"
-        ],
-        "query": {
-            "query_string": {
-                "default_field": "snippet",
-                "default_operator": "AND",
-                "query": q
-            }
-        }
-    }
-
-
-def cs_overview_query(q: str):
-    query = cs_basic_query(q)
-    query.update({
-        "aggregations": {
-            "daily": {
-                "date_histogram": {
-                    "field": "publication_date",
-                    "calendar_interval": "day",
-                    "min_doc_count": 1
-                }
-            },
-            "lang": {
-                "terms": {
-                    "field": "language",
-                    "size": 100
-                }
-            },
-            "domain": {
-                "terms": {
-                    "field": "domain",
-                    "size": 100
-                }
-            },
-            "tld": {
-                "terms": {
-                    "field": "tld",
-                    "size": 100
-                }
-            }
-        }
-    })
-    return query
-
-
-def cs_terms_query(q: str, field: str = "title", aggr: str = "top"):
-    resct = 200
-    aggr_map = {
-        "top": {
-            "terms": {
-                "field": field,
-                "size": resct,
-                "min_doc_count": 10,
-                "shard_min_doc_count": 5
-            }
-        },
-        "significant": {
-            "significant_terms": {
-                "field": field,
-                "size": resct,
-                "min_doc_count": 10,
-                "shard_min_doc_count": 5
-            }
-        },
-        "rare": {
-            "rare_terms": {
-                "field": field,
-                "exclude": "[0-9].*"
-            }
-        }
-    }
-    query = cs_basic_query(q)
-    query.update({
-        "track_total_hits": False,
-        "_source": False,
-        "aggregations": {
-            "sample": {
-                "sampler": {
-                    "shard_size": 10 if aggr == "rare" else 500
-                },
-                "aggregations": {
-                    "topterms": aggr_map[aggr]
-                }
-            }
-        }
-    })
-    return query
-
-
-def cs_paged_query(q: str, resume: Union[str, None] = None):
-    query = cs_basic_query(q)
-    query.update({
-        "size": config["maxpage"],
-        "track_total_hits": False,
-        "sort": [{"surt_url": "asc"}]
-    })
-    if resume:
-        query["search_after"] = [decode(resume)]
-    return query
-
-
-def format_match(hit: dict, base: str, collection: str, expanded: bool = False):
-    src = hit["_source"]
-    ct = src.get("first_captured") or "19700101000000"
-    res = {
-        "title": src.get("title") or "[UNKNOWN]",
-        "publication_date": (src.get("publication_date") or "")[:10],
-        "capture_time": f"{ct[:4]}-{ct[4:6]}-{ct[6:8]}T{ct[8:10]}:{ct[10:12]}:{ct[12:14]}Z",
-        "language": src.get("language") or "",
-        "domain": src["domain"],
-        "url": src["url"],
-        "original_capture_url": f"{config['wayback']}/{ct}id_/{src['url']}",
-        "archive_playback_url": f"{config['wayback']}/{ct}/{src['url']}",
-        "article_url": f"{base}/{collection}/article/{encode(hit['_id'])}"
-    }
-    if expanded:
-        res["surt_url"] = src["surt_url"]
-        res["snippet"] = src.get("snippet", "")
-        res["text_extraction_method"] = src.get("text_extraction_method", "")
-        res["version"] = src.get("version", "")
-    return res
+def resume_token(hit: dict, pit: Union[str, None] = None):
+    if pit:
+        return encode(json.dumps({"pit": pit, "sort": hit["sort"]}, separators=(",", ":")))
+    return encode(hit["sort"][0])
 
 
 def format_day_counts(bucket: list):
-    return {item["key_as_string"][:10]: item["doc_count"] for item in bucket}
+    return {item["key_as_string"][:10]: item["doc_count"] for item in bucket if item["doc_count"]}
 
 
 def format_counts(bucket: list):
     return {item["key"]: item["doc_count"] for item in bucket}
 
 
+# filter_path drops empty arrays and objects, so responses are read defensively
+def result_hits(res: dict):
+    return res.get("hits", {}).get("hits", [])
+
+
+def agg_buckets(res: dict, *path: str):
+    node = res.get("aggregations", {})
+    for name in path:
+        node = node.get(name, {})
+    return node.get("buckets", [])
+
+
+INTERVAL_UNITS = {"day": "1d", "week": "7d", "month": "1M"}
+
+
+FACET_KEYS = {"lang": "toplangs", "domain": "topdomains", "tld": "toptlds"}
+
+
+def format_overview(res: dict, payload: OverviewQuery, base: str, collection: str):
+    total = res["hits"]["total"]["value"]
+    if not total:
+        return None
+    tldsum = sum(item["doc_count"] for item in agg_buckets(res, "tld"))
+    ov = {"query": payload.q, "total": max(total, tldsum), "partial": result_partial(res)}
+    for facet in payload.facets:
+        if facet == Facet.daily:
+            # filter_path drops an empty daily aggregation, e.g. when no match has a publication_date
+            daily = res.get("aggregations", {}).get("daily", {})
+            interval = daily.get("interval", INTERVAL_UNITS.get(payload.interval.value))
+            ov.update({"interval": interval, "dailycounts": format_day_counts(agg_buckets(res, "daily"))})
+        else:
+            ov[FACET_KEYS[facet.value]] = format_counts(agg_buckets(res, facet.value))
+    if payload.size:
+        ov["matches"] = [format_match(h, base, collection) for h in result_hits(res)]
+    return ov
+
+
+def partial_headers(partial: bool):
+    return {"x-partial-result": "true"} if partial else None
+
+
+def format_terms(res: dict):
+    return format_counts(agg_buckets(res, "sample", "topterms"))
+
+
+def complete(res):
+    # Results cut short by a latency budget or shard failures are served once but never cached
+    return not (res and (res.get("partial") or res.get("errors")))
+
+
+MSGPACK_TYPES = ("application/msgpack", "application/x-msgpack")
+
+
+def negotiate(req: Request, data, headers: Union[dict, None] = None, partial: bool = False):
+    """
+    Serialize plain response data directly as JSON or MessagePack, bypassing jsonable_encoder
+    """
+    plan = getattr(req.state, "querycost", None)
+    validators = getattr(req.state, "validators", {})
+    if partial or (headers or {}).get("x-partial-result"):
+        validators = {"cache-control": "no-store"}
+    headers = {**(headers or {}), **(cost_headers(plan) if plan else {}), **validators, "vary": "Accept"}
+    accept = req.headers.get("accept", "")
+    mtype = next((mtype for mtype in MSGPACK_TYPES if mtype in accept), "application/json")
+    with timing("encode"):
+        content = orjson.dumps(data) if mtype == "application/json" else msgpack.packb(data)
+    return Response(content, media_type=mtype, headers=headers)
+
+
+def negotiate_result(req: Request, res: dict):
+    # Only overview, federated and dashboard results carry their partial state in the body
+    return negotiate(req, res, partial=not complete(res))
+
+
+def msearch_error(sres: dict):
+    err = sres["error"]
+    return err.get("reason", err.get("type")) if isinstance(err, dict) else str(err)
+
+
+def format_dashboard(res: dict, payload: OverviewQuery, base: str, collection: str, sections: list):
+    q = payload.q
+    dash = {"query": q, "overview": None, "terms": {f.value: {} for f in TermField}, "errors": {}, "partial": []}
+    for name, sres in zip(sections, res["responses"]):
+        if result_partial(sres):
+            dash["partial"].append(name)
+        if "error" in sres:
+            dash["errors"][name] = msearch_error(sres)
+        elif name == "overview":
+            dash["overview"] = format_overview(sres, payload, base, collection)
+        else:
+            _, field, aggr = name.split("/")
+            dash["terms"][field][aggr] = format_terms(sres)
+    return dash
+
+
+def merge_counts(counts: list, size: Union[int, None] = None):
+    """
+    Sum the counts of each key across collections, keeping the size largest, or all of them in key order
+    """
+    merged = Counter()
+    for count in counts:
+        merged.update(count)
+    return dict(merged.most_common(size)) if size else dict(sorted(merged.items()))
+
+
+def format_federated(res: dict, payload: FederatedQuery, base: str, collections: list):
+    fed = {"query": payload.q, "total": 0, "partial": False, "collections": {}, "errors": {}}
+    for col, sres in zip(collections, res["responses"]):
+        if "error" in sres:
+            fed["errors"][col.value] = msearch_error(sres)
+            continue
+        ov = format_overview(sres, payload, base, col.value)
+        fed["collections"][col.value] = ov and {k: v for k, v in ov.items() if k != "query"}
+    parts = [ov for ov in fed["collections"].values() if ov]
+    fed["total"] = sum(ov["total"] for ov in parts)
+    fed["partial"] = any(ov.get("partial") for ov in parts)
+    # Facet counts are summed from the top buckets of each collection, just as ES sums the top buckets of shards
+    for facet in payload.facets:
+        key = "dailycounts" if facet == Facet.daily else FACET_KEYS[facet.value]
+        counts = [ov[key] for ov in parts if key in ov]
+        if facet == Facet.daily:
+            fed["interval"] = next((ov["interval"] for ov in parts), INTERVAL_UNITS.get(payload.interval.value))
+            fed[key] = merge_counts(counts)
+        else:
+            fed[key] = merge_counts(counts, payload.facetsize)
+    return fed
+
+
 def proxy_base_url(req: Request):
     return f'{str(os.getenv("PROXY_BASE", req.base_url)).rstrip("/")}/{req.scope.get("root_path").lstrip("/")}'
 
@@ -309,89 +366,341 @@ def search_root(collection: Collection, req: Request):
     spath = f"{req.scope.get('root_path')}/{collection.value}/search"
     return "\n".join(['<ul>',
                       f'<li><a href="{spath}/overview">Search Overview</a></li>',
+                      f'<li><a href="{spath}/count">Search Count</a></li>',
                       f'<li><a href="{spath}/result">Search Result</a></li>',
+                      f'<li><a href="{spath}/dashboard">Search Dashboard</a></li>',
+                      f'<li><a href="{spath}/export">Search Export</a></li>',
                       '</ul>'])
 
 
-def _search_overview(collection: Collection, q: str, req: Request):
-    res = ES.search(index=collection.name, body=cs_overview_query(q))
-    if not res["hits"]["hits"]:
+def overview_key(name: str, index: str, payload: OverviewQuery, base: str):
+    facets = tuple(sorted({f.value for f in payload.facets}))
+    return (name, index, normalize_query(payload.q), payload.start, payload.end, payload.interval.value,
+            facets, payload.facetsize, payload.size, base)
+
+
+async def _search_overview(collection: Collection, req: Request, payload: OverviewQuery):
+    GUARD.check(req, payload.q)
+    base = proxy_base_url(req)
+    key = overview_key("overview", collection.name, payload, base)
+    ttl = config["cachettl"]["overview"]
+    res = await CACHE.get_or_set(key, ttl, lambda: _fetch_overview(collection, payload, base), complete)
+    if not res:
         raise HTTPException(status_code=404, detail="No results found!")
-    total = res["hits"]["total"]["value"]
-    tldsum = sum(item["doc_count"] for item in res["aggregations"]["tld"]["buckets"])
+    return {**res, "query": payload.q}
+
+
+async def _fetch_overview(collection: Collection, payload: OverviewQuery, base: str):
+    q = payload.q
+    query = cs_budget(cs_overview_query(payload), "overview")
+    if not payload.facets and not payload.size:
+        # A bare total needs neither hits nor aggregations, so the cheaper count API is enough
+        params = cs_search_params(q, query, ["count"])
+        params.pop("request_cache")
+        params["request_timeout"] = request_timeout("overview")
+        async with ADMISSION.hold([collection.value], "aggregation"):
+            res = await ES.count(index=collection.name, body={"query": query["query"]}, params=params)
+        return {"query": q, "total": res["count"]} if res["count"] else None
+    async with ADMISSION.hold([collection.value], "aggregation"):
+        res = await PARTITIONS.search(collection.name, payload) if PARTITIONS.usable(payload) else None
+        if res is None:
+            params = cs_search_params(q, query, FILTER_PATHS["overview"])
+            params["request_timeout"] = request_timeout("overview")
+            res = await ES.search(index=collection.name, body=query, params=params)
+    with formatting():
+        return format_overview(res, payload, base, collection.value)
+
+
+@v1.get("/{collection}/search/overview", tags=["data"], dependencies=CACHED["overview"])
+@v1.head("/{collection}/search/overview", include_in_schema=False, dependencies=CACHED["overview"])
+async def search_overview_via_query_params(collection: Collection, q: str, req: Request,  # pylint: disable=too-many-arguments,too-many-positional-arguments
+                                           start: Union[date, None] = None, end: Union[date, None] = None,
+                                           interval: Interval = Interval.day,
+                                           facets: List[Facet] = QueryParam(list(Facet)),
+                                           facetsize: int = QueryParam(100, ge=1, le=config["maxbuckets"]),
+                                           size: int = QueryParam(10, ge=0, le=config["maxpage"])):
+    """
+    Report overview summary of the search result, optionally within a publication date range
+
+    The `auto` interval picks the finest date histogram granularity that stays within the bucket limit.
+    Only the listed `facets` are computed, `size=0` skips the top hits, and with neither a plain count is returned.
+    """
+    payload = OverviewQuery(q=q, start=start, end=end, interval=interval, facets=facets, facetsize=facetsize, size=size)
+    return negotiate_result(req, await _search_overview(collection, req, payload))
+
+
+@v1.post("/{collection}/search/overview", tags=["data"])
+async def search_overview_via_payload(collection: Collection, req: Request, payload: OverviewQuery):
+    """
+    Report summary of the search result, optionally within a publication date range and limited to some facets
+    """
+    return negotiate_result(req, await _search_overview(collection, req, payload))
+
+
+async def _search_federated(req: Request, payload: FederatedQuery):
+    GUARD.check(req, payload.q)
+    collections = [col for col in Collection if col in payload.collections]
+    if payload.interval == Interval.auto and Facet.daily in payload.facets and len(collections) > 1:
+        raise HTTPException(status_code=400, detail="The auto interval may differ across collections, pick one!")
     base = proxy_base_url(req)
-    return {
-        "query": q,
-        "total": max(total, tldsum),
-        "topdomains": format_counts(res["aggregations"]["domain"]["buckets"]),
-        "toptlds": format_counts(res["aggregations"]["tld"]["buckets"]),
-        "toplangs": format_counts(res["aggregations"]["lang"]["buckets"]),
-        "dailycounts": format_day_counts(res["aggregations"]["daily"]["buckets"]),
-        "matches": [format_match(h, base, collection.value) for h in res["hits"]["hits"]]
-    }
+    key = overview_key("federated", ",".join(col.name for col in collections), payload, base)
+    ttl = config["cachettl"]["overview"]
+    res = await CACHE.get_or_set(key, ttl, lambda: _fetch_federated(collections, payload, base), complete)
+    if not res["total"] and not res["errors"]:
+        raise HTTPException(status_code=404, detail="No results found!")
+    return {**res, "query": payload.q}
+
+
+async def _fetch_federated(collections: list, payload: FederatedQuery, base: str):
+    query = cs_budget(cs_overview_query(payload), "overview")
+    msearch = cs_msearch(payload.q, [query] * len(collections))
+    for header, col in zip(msearch["body"][::2], collections):
+        header["index"] = col.name
+    msearch["params"]["request_timeout"] = request_timeout("overview")
+    # A federated search holds an aggregation slot in every collection it reads
+    async with ADMISSION.hold([col.value for col in collections], "aggregation"):
+        res = await ES.msearch(**msearch)
+    with formatting():
+        return format_federated(res, payload, base, collections)
+
+
+@v1.get("/search/overview", tags=["data"])
+@v1.head("/search/overview", include_in_schema=False)
+async def search_federated_via_query_params(q: str, req: Request,  # pylint: disable=too-many-arguments,too-many-positional-arguments
+                                            collections: List[Collection] = QueryParam(list(Collection)),
+                                            start: Union[date, None] = None, end: Union[date, None] = None,
+                                            interval: Interval = Interval.day,
+                                            facets: List[Facet] = QueryParam(list(Facet)),
+                                            facetsize: int = QueryParam(100, ge=1, le=config["maxbuckets"]),
+                                            size: int = QueryParam(10, ge=0, le=config["maxpage"])):
+    """
+    Report overview summary of the search result across collections, merged and broken down by collection
+
+    All collections are searched in a single round trip, unless a subset is listed in `collections`.
+    """
+    payload = FederatedQuery(q=q, collections=collections, start=start, end=end, interval=interval, facets=facets,
+                             facetsize=facetsize, size=size)
+    return negotiate_result(req, await _search_federated(req, payload))
 
 
-@v1.get("/{collection}/search/overview", tags=["data"])
-@v1.head("/{collection}/search/overview", include_in_schema=False)
-def search_overview_via_query_params(collection: Collection, q: str, req: Request):
+@v1.post("/search/overview", tags=["data"])
+async def search_federated_via_payload(req: Request, payload: FederatedQuery):
     """
-    Report overview summary of the search result
+    Report overview summary of the search result across collections, merged and broken down by collection
     """
-    return _search_overview(collection, q, req)
+    return negotiate_result(req, await _search_federated(req, payload))
 
 
-@v1.post("/{collection}/search/overview", tags=["data"])
-def search_overview_via_payload(collection: Collection, req: Request, payload: Query):
+@v1.get("/{collection}/search/count", tags=["data"], dependencies=CACHED["count"])
+@v1.head("/{collection}/search/count", include_in_schema=False, dependencies=CACHED["count"])
+async def search_count(collection: Collection, q: str, req: Request,
+                       start: Union[date, None] = None, end: Union[date, None] = None):
     """
-    Report summary of the search result
+    Report only the total number of matching articles, optionally within a publication date range
     """
-    return _search_overview(collection, payload.q, req)
+    payload = OverviewQuery(q=q, start=start, end=end, facets=[], size=0)
+    return negotiate_result(req, await _search_overview(collection, req, payload))
+
+
+async def open_pit(collection: Collection, resume: Union[str, None] = None, pit: bool = False):
+    if not pit or resume:
+        return None
+    res = await ES.open_point_in_time(index=collection.name, params={"keep_alive": config["pitkeepalive"]})
+    return res["id"]
+
+
+async def close_pit(pit: Union[str, None]):
+    if not pit:
+        return
+    try:
+        await ES.close_point_in_time(body={"id": pit})
+    except TransportError:
+        pass
+
 
+async def paged_search(collection: Collection, q: str, resume: Union[str, None] = None, pit: Union[str, None] = None):
+    query = cs_paged_query(q, resume, pit)
+    params = cs_search_params(q, query, FILTER_PATHS["paged"])
+    # PIT searches must not name an index, the point in time already pins it
+    return await ES.search(index=None if "pit" in query else collection.name, body=query, params=params)
 
-def _search_result(collection: Collection, q: str, req: Request, resp: Response, resume: Union[str, None] = None):
-    res = ES.search(index=collection.name, body=cs_paged_query(q, resume))
-    if not res["hits"]["hits"]:
+
+async def prefetched_search(collection: Collection, q: str, resume: Union[str, None], pit: Union[str, None]):
+    task = PREFETCH.take((collection.name, normalize_query(q), resume)) if resume else None
+    if task:
+        try:
+            return await task
+        except (TransportError, HTTPException):
+            # A failed or rejected prefetch is retried as a regular search
+            pass
+    return await paged_search(collection, q, resume, pit)
+
+
+async def admitted_search(collection: Collection, q: str, resume: str):
+    async with ADMISSION.hold([collection.value], "paging"):
+        return await paged_search(collection, q, resume)
+
+
+async def _search_result(collection: Collection, req: Request, payload: PagedQuery):
+    q = payload.q
+    GUARD.check(req, q)
+    pit = await open_pit(collection, payload.resume, payload.pit)
+    try:
+        res = await prefetched_search(collection, q, payload.resume, pit)
+    except BaseException:
+        # Nothing refers to a point in time whose first search failed, so it would stay open until it expires
+        await close_pit(pit)
+        raise
+    hits = result_hits(res)
+    pit_id = res.get("pit_id")
+    if len(hits) < config["maxpage"]:
+        await close_pit(pit_id)
+    if not hits:
         raise HTTPException(status_code=404, detail="No results found!")
     base = proxy_base_url(req)
-    qurl = f"{base}/{collection.value}/search/result?q={quote_plus(q)}"
-    if len(res["hits"]["hits"]) == config["maxpage"]:
-        resume_key = encode(res["hits"]["hits"][-1]["sort"][0])
-        resp.headers["x-resume-token"] = resume_key
-        resp.headers["link"] = f'<{qurl}&resume={resume_key}>; rel="next"'
-    return [format_match(h, base, collection.value) for h in res["hits"]["hits"]]
+    qurl = f"{base}/{collection.value}/search/result?q={quote_plus(q)}{'&prefetch=true' if payload.prefetch else ''}"
+    headers = {}
+    if len(hits) == config["maxpage"]:
+        resume_key = resume_token(hits[-1], pit_id)
+        headers["x-resume-token"] = resume_key
+        headers["link"] = f'<{qurl}&resume={resume_key}>; rel="next"'
+        if payload.prefetch and ADMISSION.available(collection.value, "paging"):
+            # Fetch the next page while this one is formatted and transferred, most clients ask for it right after.
+            # It is skipped when paging is saturated, and otherwise takes a paging slot like any other search
+            PREFETCH.start((collection.name, normalize_query(q), resume_key),
+                           lambda: admitted_search(collection, q, resume_key))
+    with formatting():
+        matches = [format_match(h, base, collection.value) for h in hits]
+    return negotiate(req, matches, headers)
+
+
+@v1.get("/{collection}/search/result", tags=["data"], dependencies=CACHED["result"] + PAGING)
+@v1.head("/{collection}/search/result", include_in_schema=False, dependencies=CACHED["result"] + PAGING)
+async def search_result_via_query_params(collection: Collection, q: str, req: Request,  # pylint: disable=too-many-arguments,too-many-positional-arguments
+                                         resume: Union[str, None] = None, pit: bool = False, prefetch: bool = False):
+    """
+    Paged response of search result, optionally over a consistent point-in-time snapshot
+
+    With `prefetch` the next page is fetched ahead while the current one is sent, to speed up sequential harvesting.
+    """
+    return await _search_result(collection, req, PagedQuery(q=q, resume=resume, pit=pit, prefetch=prefetch))
 
 
-@v1.get("/{collection}/search/result", tags=["data"])
-@v1.head("/{collection}/search/result", include_in_schema=False)
-def search_result_via_query_params(collection: Collection, q: str, req: Request, resp: Response, resume: Union[str, None] = None):  # pylint: disable=line-too-long
+@v1.post("/{collection}/search/result", tags=["data"], dependencies=PAGING)
+async def search_result_via_payload(collection: Collection, req: Request, payload: PagedQuery):
+    """
+    Paged response of search result, optionally over a consistent point-in-time snapshot
+    """
+    return await _search_result(collection, req, payload)
+
+
+async def _export_pages(collection: Collection, q: str, res: dict):
+    pending = None
+    try:
+        while result_hits(res):
+            hits = result_hits(res)
+            if len(hits) == config["maxpage"]:
+                pending = asyncio.ensure_future(paged_search(collection, q, resume_token(hits[-1], res.get("pit_id"))))
+            yield hits
+            if not pending:
+                break
+            res = await pending
+            pending = None
+    finally:
+        if pending:
+            pending.cancel()
+        await close_pit(res.get("pit_id"))
+
+
+async def _export_ndjson(pages, base: str, collection: str):
+    async for hits in pages:
+        with formatting():
+            lines = [orjson.dumps(format_match(h, base, collection), option=orjson.OPT_APPEND_NEWLINE) for h in hits]
+        yield b"".join(lines)
+
+
+async def _export_csv(pages, base: str, collection: str):
+    buf = io.StringIO()
+    writer = None
+    async for hits in pages:
+        with formatting():
+            for h in hits:
+                row = format_match(h, base, collection)
+                if not writer:
+                    writer = csv.DictWriter(buf, fieldnames=list(row))
+                    writer.writeheader()
+                writer.writerow(row)
+        yield buf.getvalue()
+        buf.seek(0)
+        buf.truncate()
+
+
+async def _search_export(collection: Collection, req: Request, payload: ExportQuery):
+    q = payload.q
+    fmt = payload.format
+    plan = GUARD.check(req, q)
+    pit = await open_pit(collection, pit=payload.pit)
+    try:
+        res = await paged_search(collection, q, pit=pit)
+    except BaseException:
+        await close_pit(pit)
+        raise
+    if not result_hits(res):
+        await close_pit(res.get("pit_id"))
+        raise HTTPException(status_code=404, detail="No results found!")
+    base = proxy_base_url(req)
+    pages = _export_pages(collection, q, res)
+    headers = {"content-disposition": f'attachment; filename="{collection.value}-export.{fmt.value}"',
+               **cost_headers(plan)}
+    if fmt == ExportFormat.csv:
+        return StreamingResponse(_export_csv(pages, base, collection.value), media_type="text/csv", headers=headers)
+    return StreamingResponse(_export_ndjson(pages, base, collection.value), media_type="application/x-ndjson",
+                             headers=headers)
+
+
+@v1.get("/{collection}/search/export", tags=["data"], dependencies=EXPORT)
+async def search_export_via_query_params(collection: Collection, q: str, req: Request,
+                                         format: ExportFormat = ExportFormat.ndjson,  # pylint: disable=redefined-builtin
+                                         pit: bool = False):
     """
-    Paged response of search result
+    Stream the complete search result as NDJSON or CSV
     """
-    return _search_result(collection, q, req, resp, resume)
+    return await _search_export(collection, req, ExportQuery(q=q, format=format, pit=pit))
 
 
-@v1.post("/{collection}/search/result", tags=["data"])
-def search_result_via_payload(collection: Collection, req: Request, resp: Response, payload: PagedQuery):
+@v1.post("/{collection}/search/export", tags=["data"], dependencies=EXPORT)
+async def search_export_via_payload(collection: Collection, req: Request, payload: ExportQuery):
     """
-    Paged response of search result
+    Stream the complete search result as NDJSON or CSV
     """
-    return _search_result(collection, payload.q, req, resp, payload.resume)
+    return await _search_export(collection, req, payload)
 
 
 if config["debug"]:
     @v1.post("/{collection}/search/esdsl", tags=["debug"])
-    def search_esdsl_via_payload(collection: Collection, payload: dict = Body(...)):
+    async def search_esdsl_via_payload(collection: Collection, payload: dict = Body(...)):
         """
         Search using ES Query DSL as JSON payload
         """
-        return ES.search(index=collection.name, body=payload)
+        return await ES.search(index=collection.name, body=payload)
 
 
-def _get_terms(collection: Collection, q: str, field: TermField, aggr: TermAggr):
-    res = ES.search(index=collection.name, body=cs_terms_query(q, field, aggr))
-    if not res["hits"]["hits"] or not res["aggregations"]["sample"]["topterms"]["buckets"]:
+async def _get_terms(collection: Collection, q: str, field: TermField, aggr: TermAggr):
+    key = ("terms", collection.name, normalize_query(q), field, aggr)
+    res = await CACHE.get_or_set(key, config["cachettl"]["terms"], lambda: _fetch_terms(collection, q, field, aggr),
+                               complete)
+    if not res["terms"]:
         raise HTTPException(status_code=404, detail="No results found!")
-    return format_counts(res["aggregations"]["sample"]["topterms"]["buckets"])
+    return res
+
+
+async def _fetch_terms(collection: Collection, q: str, field: TermField, aggr: TermAggr):
+    query = cs_budget(cs_terms_query(q, field, aggr), "terms")
+    params = {**cs_search_params(q, query, FILTER_PATHS["terms"]), "request_timeout": request_timeout("terms")}
+    async with ADMISSION.hold([collection.value], "aggregation"):
+        res = await ES.search(index=collection.name, body=query, params=params)
+    with formatting():
+        return {"terms": format_terms(res), "partial": result_partial(res)}
 
 
 @v1.get("/{collection}/terms", response_class=HTMLResponse, tags=["info"])
@@ -416,35 +725,114 @@ def term_aggr_root(collection: Collection, req: Request, field: TermField):
     return "\n".join(['<ul>'] + lis + ['</ul>'])
 
 
-@v1.get("/{collection}/terms/{field}/{aggr}", tags=["data"])
-@v1.head("/{collection}/terms/{field}/{aggr}", include_in_schema=False)
-def get_terms_via_query_params(collection: Collection, q: str, field: TermField, aggr: TermAggr):
+@v1.get("/{collection}/terms/{field}/{aggr}", tags=["data"], dependencies=CACHED["terms"])
+@v1.head("/{collection}/terms/{field}/{aggr}", include_in_schema=False, dependencies=CACHED["terms"])
+async def get_terms_via_query_params(collection: Collection, q: str, req: Request, field: TermField, aggr: TermAggr):
     """
     Top terms with frequencies in matching articles
     """
-    return _get_terms(collection, q, field.value, aggr.value)
+    GUARD.check(req, q)
+    res = await _get_terms(collection, q, field.value, aggr.value)
+    return negotiate(req, res["terms"], partial_headers(res["partial"]))
 
 
 @v1.post("/{collection}/terms/{field}/{aggr}", tags=["data"])
-def get_terms_via_payload(collection: Collection, payload: Query, field: TermField, aggr: TermAggr):
+async def get_terms_via_payload(collection: Collection, req: Request, payload: Query, field: TermField, aggr: TermAggr):
     """
     Top terms with frequencies in matching articles
     """
-    return _get_terms(collection, payload.q, field.value, aggr.value)
+    GUARD.check(req, payload.q)
+    res = await _get_terms(collection, payload.q, field.value, aggr.value)
+    return negotiate(req, res["terms"], partial_headers(res["partial"]))
+
+
+async def _search_dashboard(collection: Collection, req: Request, payload: OverviewQuery):
+    GUARD.check(req, payload.q)
+    base = proxy_base_url(req)
+    key = overview_key("dashboard", collection.name, payload, base)
+    ttl = config["cachettl"]["dashboard"]
+    res = await CACHE.get_or_set(key, ttl, lambda: _fetch_dashboard(collection, payload, base), complete)
+    if not res["overview"]:
+        raise HTTPException(status_code=404, detail="No results found!")
+    return {**res, "query": payload.q, "overview": {**res["overview"], "query": payload.q}}
+
+
+async def _fetch_dashboard(collection: Collection, payload: OverviewQuery, base: str):
+    q, start, end = payload.q, payload.start, payload.end
+    sections = [("overview", cs_overview_query(payload))]
+    sections += [(f"terms/{fld.value}/{aggr.value}", cs_terms_query(q, fld.value, aggr.value, start, end))
+                 for fld in TermField for aggr in TermAggr]
+    msearch = cs_msearch(q, [cs_budget(query, "dashboard") for _, query in sections])
+    msearch["params"]["request_timeout"] = request_timeout("dashboard")
+    async with ADMISSION.hold([collection.value], "aggregation"):
+        res = await ES.msearch(index=collection.name, **msearch)
+    with formatting():
+        return format_dashboard(res, payload, base, collection.value, [name for name, _ in sections])
+
+
+@v1.get("/{collection}/search/dashboard", tags=["data"], dependencies=CACHED["dashboard"])
+@v1.head("/{collection}/search/dashboard", include_in_schema=False, dependencies=CACHED["dashboard"])
+async def search_dashboard_via_query_params(collection: Collection, q: str, req: Request,  # pylint: disable=too-many-arguments,too-many-positional-arguments
+                                            start: Union[date, None] = None, end: Union[date, None] = None,
+                                            interval: Interval = Interval.day):
+    """
+    Search overview and all related term aggregations in a single round trip
+    """
+    payload = OverviewQuery(q=q, start=start, end=end, interval=interval)
+    return negotiate_result(req, await _search_dashboard(collection, req, payload))
+
+
+@v1.post("/{collection}/search/dashboard", tags=["data"])
+async def search_dashboard_via_payload(collection: Collection, req: Request, payload: OverviewQuery):
+    """
+    Search overview and all related term aggregations in a single round trip
+    """
+    return negotiate_result(req, await _search_dashboard(collection, req, payload))
 
 
-@v1.get("/{collection}/article/{id}", tags=["data"])
-@v1.head("/{collection}/article/{id}", include_in_schema=False)
-def get_article(collection: Collection, id: str, req: Request):  # pylint: disable=redefined-builtin
+@v1.get("/{collection}/article/{id}", tags=["data"], dependencies=CACHED["article"] + ARTICLE)
+@v1.head("/{collection}/article/{id}", include_in_schema=False, dependencies=CACHED["article"] + ARTICLE)
+async def get_article(collection: Collection, id: str, req: Request):  # pylint: disable=redefined-builtin
     """
     Fetch an individual article record by ID
     """
     try:
-        hit = ES.get(index=collection.name, id=decode(id))
+        hit = await ES.get(index=collection.name, id=decode(id), params={"filter_path": ",".join(FILTER_PATHS["get"])})
     except TransportError as e:
         raise HTTPException(status_code=404, detail=f"An article with ID {decode(id)} not found!") from e
     base = proxy_base_url(req)
-    return format_match(hit, base, collection.value, True)
+    with formatting():
+        article = format_match(hit, base, collection.value, True)
+    return negotiate(req, article)
+
+
+@v1.post("/{collection}/articles", tags=["data"], dependencies=ARTICLE)
+async def get_articles(collection: Collection, req: Request, payload: ArticleIds):
+    """
+    Fetch a batch of article records by their IDs
+    """
+    if len(payload.ids) > config["maxpage"]:
+        raise HTTPException(status_code=413, detail=f"At most {config['maxpage']} IDs can be fetched at once!")
+    ids = {}
+    notfound = []
+    for eid in payload.ids:
+        try:
+            ids[decode(eid)] = eid
+        except (binascii.Error, UnicodeDecodeError):
+            notfound.append(eid)
+    keys = list(ids)
+    chunks = [keys[i:i + config["mgetchunk"]] for i in range(0, len(keys), config["mgetchunk"])]
+    params = {"filter_path": ",".join(FILTER_PATHS["mget"])}
+    res = await asyncio.gather(*[ES.mget(index=collection.name, body={"ids": ch}, params=params) for ch in chunks])
+    base = proxy_base_url(req)
+    articles = []
+    with formatting():
+        for doc in (d for r in res for d in r["docs"]):
+            if doc.get("found"):
+                articles.append(format_match(doc, base, collection.value, True))
+            else:
+                notfound.append(ids[doc["_id"]])
+    return negotiate(req, {"articles": articles, "notfound": notfound})
 
 
 app.mount(f"/{ApiVersion.v1.name}", v1)
@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+
+import argparse
+import asyncio
+import json
+import statistics
+import subprocess
+import time
+
+from datetime import datetime, timezone
+
+import aiohttp
+
+from utils import load_config, env_to_list, encode
+
+
+config = load_config()
+config["indexes"] = env_to_list("INDEXES") or config.get("indexes", [])
+config["termfields"] = env_to_list("TERMFIELDS") or config.get("termfields", ["title", "snippet"])
+config["termaggrs"] = env_to_list("TERMAGGRS") or config.get("termaggrs", ["top", "significant", "rare"])
+
+QUERIES = ["covid", "climate change", "election -fraud", "title:vaccine", "economy AND inflation"]
+
+
+def endpoint_requests(col: str, name: str, i: int):
+    """
+    Method, path and JSON payload of the i-th request of a benchmarked endpoint
+    """
+    q = QUERIES[i % len(QUERIES)]
+    if name == "terms":
+        fld = config["termfields"][i % len(config["termfields"])]
+        aggr = config["termaggrs"][(i // len(config["termfields"])) % len(config["termaggrs"])]
+        return "GET", f"/{col}/terms/{fld}/{aggr}", {"q": q}, None
+    if name == "federated":
+        return "GET", "/search/overview", {"q": q}, None
+    if name == "article":
+        return "GET", f"/{col}/article/{encode(f'doc-{i % 1000}')}", {}, None
+    if name == "articles":
+        return "POST", f"/{col}/articles", {}, {"ids": [encode(f"doc-{i + j}") for j in range(100)]}
+    return "GET", f"/{col}/search/{name}", {"q": q}, None
+
+
+ENDPOINTS = ["overview", "federated", "count", "result", "terms", "dashboard", "article", "articles", "export"]
+
+
+async def run_endpoint(session: aiohttp.ClientSession, api: str, col: str, name: str, args):
+    latencies = []
+    errors = 0
+    nbytes = 0
+    counter = iter(range(10 ** 9))
+    deadline = time.perf_counter() + args.duration
+
+    async def worker():
+        nonlocal errors, nbytes
+        while time.perf_counter() < deadline:
+            method, path, params, payload = endpoint_requests(col, name, next(counter))
+            start = time.perf_counter()
+            try:
+                async with session.request(method, f"{api}{path}", params=params, json=payload) as r:
+                    body = await r.read()
+                    if r.status >= 400:
+                        errors += 1
+                        continue
+            except aiohttp.ClientError:
+                errors += 1
+                continue
+            latencies.append(time.perf_counter() - start)
+            nbytes += len(body)
+
+    start = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(args.concurrency)])
+    elapsed = time.perf_counter() - start
+    pct = statistics.quantiles(latencies, n=100, method="inclusive") if len(latencies) > 1 else [0.0] * 99
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "rps": round(len(latencies) / elapsed, 2),
+        "p50_ms": round(pct[49] * 1000, 2),
+        "p95_ms": round(pct[94] * 1000, 2),
+        "p99_ms": round(pct[98] * 1000, 2),
+        "mbytes": round(nbytes / 1048576, 2)
+    }
+
+
+async def run(args):
+    col = args.collection or config["indexes"][0].split(":")[-1]
+    conn = aiohttp.TCPConnector(limit=args.concurrency)
+    timeout = aiohttp.ClientTimeout(total=args.timeout)
+    results = {}
+    async with aiohttp.ClientSession(connector=conn, timeout=timeout) as session:
+        for name in args.endpoints:
+            results[name] = await run_endpoint(session, args.api.rstrip("/"), col, name, args)
+            print_row(name, results[name])
+    return col, results
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+
+
+def print_row(name: str, res: dict):
+    print(f"{name:<12}" + "".join(f"{res[k]:>12}" for k in ("requests", "errors", "rps", "p50_ms", "p95_ms", "p99_ms")))
+
+
+def compare(path: str, last: int):
+    with open(path, encoding="UTF-8") as f:
+        runs = [json.loads(line) for line in f if line.strip()][-last:]
+    print(f"{'endpoint':<12}" + "".join(f"{r['commit'] or '?':>22}" for r in runs))
+    for name in dict.fromkeys(n for r in runs for n in r["results"]):
+        cells = [r["results"].get(name) for r in runs]
+        print(f"{name:<12}" + "".join(f"{c['rps']:>10} rps {c['p99_ms']:>6} p99" if c else f"{'-':>22}"
+                                      for c in cells))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the data endpoints of the API")
+    parser.add_argument("--api", default="http://localhost:8000/v1", help="base URL of the versioned API")
+    parser.add_argument("--collection", help="collection to query (default: first configured index)")
+    parser.add_argument("--endpoints", nargs="+", default=ENDPOINTS, choices=ENDPOINTS, help="endpoints to hit")
+    parser.add_argument("--concurrency", type=int, default=20, help="concurrent requests per endpoint")
+    parser.add_argument("--duration", type=float, default=10, help="seconds to load each endpoint")
+    parser.add_argument("--timeout", type=float, default=60, help="per-request timeout in seconds")
+    parser.add_argument("--label", default="", help="free-form label stored with the results")
+    parser.add_argument("--output", default="bench-results.jsonl", help="file to append the results to")
+    parser.add_argument("--compare", type=int, metavar="N", help="compare the last N stored runs instead")
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(args.output, args.compare)
+    else:
+        print(f"{'endpoint':<12}" + "".join(f"{k:>12}" for k in ("requests", "errors", "rps", "p50", "p95", "p99")))
+        collection, results = asyncio.run(run(args))
+        record = {
+            "timestamp": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "commit": git_commit(),
+            "label": args.label,
+            "collection": collection,
+            "concurrency": args.concurrency,
+            "duration": args.duration,
+            "results": results
+        }
+        with open(args.output, "a", encoding="UTF-8") as f:
+            f.write(json.dumps(record) + "\n")
+
+
+if __name__ == "__main__":
+    main()
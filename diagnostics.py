@@ -0,0 +1,200 @@
+import cProfile
+import itertools
+import marshal
+import os
+import random
+import sys
+import threading
+import time
+
+from collections import Counter, deque
+from datetime import datetime, timezone
+
+from starlette.datastructures import MutableHeaders
+
+from metrics import TIMINGS
+
+
+DEFAULT_PROFILING = {
+    "servertiming": True,
+    "rate": 0,
+    "threshold": 0,
+    "interval": 0.005,
+    "size": 20
+}
+
+# Phases in the order they happen, with the descriptions shown by browser developer tools
+PHASES = {
+    "query": "Query building",
+    "es": "ES round trip",
+    "took": "ES took",
+    "format": "Response formatting",
+    "encode": "Response encoding",
+    "total": "Total"
+}
+
+
+def server_timing(timings: dict):
+    return ", ".join(f'{name};dur={timings[name] * 1000:.1f};desc="{desc}"'
+                     for name, desc in PHASES.items() if name in timings)
+
+
+def fold_stack(frame):
+    names = []
+    while frame:
+        names.append(f"{os.path.basename(frame.f_code.co_filename)}:{frame.f_code.co_name}")
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+class StackSampler:
+    """
+    Background thread sampling the stack of the event loop thread into a count of folded stacks per watched request
+    """
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.watched = {}
+        self.lock = threading.Lock()
+        self.busy = threading.Event()
+        self.loop_thread = None
+        self.thread = None
+
+    def watch(self, key: int):
+        if not self.thread:
+            self.loop_thread = threading.get_ident()
+            self.thread = threading.Thread(target=self._sample, name="stack-sampler", daemon=True)
+            self.thread.start()
+        with self.lock:
+            self.watched[key] = Counter()
+            self.busy.set()
+
+    def unwatch(self, key: int):
+        with self.lock:
+            stacks = self.watched.pop(key, None)
+            # Sleep until the next request rather than waking up an idle process
+            if not self.watched:
+                self.busy.clear()
+        return stacks
+
+    def _sample(self):
+        while True:
+            self.busy.wait()
+            time.sleep(self.interval)
+            frame = sys._current_frames().get(self.loop_thread)  # pylint: disable=protected-access
+            if frame is None:
+                continue
+            stack = fold_stack(frame)
+            with self.lock:
+                for stacks in self.watched.values():
+                    stacks[stack] += 1
+
+
+class Profiler:
+    """
+    Bounded ring buffer of request profiles, with cProfile stats of a sampled fraction of requests
+    and event loop stack samples of requests slower than a threshold
+
+    Both observe the whole event loop while a request is in flight, so concurrent requests show up in each other's
+    profiles, the same way they compete for the loop in production.
+    """
+
+    def __init__(self, settings: dict):
+        self.rate = float(settings["rate"])
+        self.threshold = float(settings["threshold"])
+        self.sampler = StackSampler(float(settings["interval"])) if self.threshold > 0 else None
+        self.profiles = deque(maxlen=int(settings["size"]))
+        self.ids = itertools.count(1)
+        self.profiling = False
+
+    @property
+    def enabled(self):
+        return self.rate > 0 or self.threshold > 0
+
+    def start(self, key: int):
+        """
+        Watch the stacks of a request when slow requests are kept, and profile it if it is sampled
+        """
+        if self.sampler:
+            self.sampler.watch(key)
+        # Only one cProfile profiler can be active in a thread at a time, so overlapping samples are skipped
+        if self.profiling or self.rate <= 0 or random.random() >= self.rate:
+            return None
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            return None
+        self.profiling = True
+        return profile
+
+    def finish(self, key: int, profile, scope: dict, status: int, seconds: float):  # pylint: disable=too-many-arguments,too-many-positional-arguments
+        """
+        Keep the cProfile stats of a sampled request, or else the stack samples of a slow one
+        """
+        stacks = self.sampler.unwatch(key) if self.sampler else None
+        if profile:
+            profile.disable()
+            self.profiling = False
+            profile.create_stats()
+            self._keep("cprofile", marshal.dumps(profile.stats), scope, status, seconds)
+        elif stacks and seconds >= self.threshold:
+            data = "".join(f"{stack} {count}\n" for stack, count in sorted(stacks.items())).encode()
+            self._keep("stacks", data, scope, status, seconds)
+
+    def _keep(self, kind: str, data: bytes, scope: dict, status: int, seconds: float):  # pylint: disable=too-many-arguments,too-many-positional-arguments
+        self.profiles.append({
+            "id": next(self.ids),
+            "kind": kind,
+            "time": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "method": scope["method"],
+            "path": scope["path"],
+            "query": scope.get("query_string", b"").decode("latin-1"),
+            "status": status,
+            "seconds": round(seconds, 6),
+            "bytes": len(data),
+            "data": data
+        })
+
+    def listing(self):
+        return [{k: v for k, v in p.items() if k != "data"} for p in reversed(self.profiles)]
+
+    def get(self, pid: int):
+        return next((p for p in self.profiles if p["id"] == pid), None)
+
+
+class TimingMiddleware:  # pylint: disable=too-few-public-methods
+    """
+    ASGI middleware that reports the time spent in each phase of a request in a Server-Timing header
+    and hands requests to the sampling profiler
+    """
+
+    def __init__(self, app, profiler: Profiler, servertiming=True):
+        self.app = app
+        self.profiler = profiler
+        self.servertiming = str(servertiming).lower() in ("true", "1", "t")
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        timings = {}
+        token = TIMINGS.set(timings)
+        resp = {"status": 500}
+
+        async def send_wrapper(msg):
+            if msg["type"] == "http.response.start":
+                resp["status"] = msg["status"]
+                if self.servertiming:
+                    timings["total"] = time.perf_counter() - start
+                    MutableHeaders(scope=msg).append("server-timing", server_timing(timings))
+            await send(msg)
+
+        key = id(timings)
+        profile = self.profiler.start(key)
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            self.profiler.finish(key, profile, scope, resp["status"], time.perf_counter() - start)
+            TIMINGS.reset(token)
@@ -0,0 +1,276 @@
+#!/usr/bin/env python3
+
+import argparse
+import gzip
+import json
+import os
+import sys
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime, timezone
+
+import orjson
+
+from elasticsearch import Elasticsearch
+from elasticsearch.exceptions import NotFoundError, TransportError
+
+from models import Collection
+from queries import FILTER_PATHS, cs_basic_query, format_match
+from settings import config
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+
+EXPANDED_SOURCE = ["surt_url", "snippet", "text_extraction_method", "version"]
+EXTENSIONS = {"ndjson": "ndjson.gz", "parquet": "parquet"}
+
+
+def write_json(path: str, data: dict):
+    # Written aside and renamed, so an interrupted job never leaves a truncated checkpoint behind
+    with open(f"{path}.tmp", "wb") as f:
+        f.write(orjson.dumps(data, option=orjson.OPT_INDENT_2))
+    os.replace(f"{path}.tmp", path)
+
+
+def read_json(path: str):
+    try:
+        with open(path, "rb") as f:
+            return orjson.loads(f.read())
+    except FileNotFoundError:
+        return None
+
+
+class NdjsonShard:
+    """
+    Gzip compressed NDJSON part file, written under a temporary name until it is complete
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.docs = 0
+        self.file = gzip.open(f"{path}.tmp", "wb", compresslevel=6)
+
+    def write(self, rows: list):
+        self.file.write(b"".join(orjson.dumps(row, option=orjson.OPT_APPEND_NEWLINE) for row in rows))
+        self.docs += len(rows)
+
+    def close(self):
+        self.file.close()
+        os.replace(f"{self.path}.tmp", self.path)
+
+    def abort(self):
+        if self.file:
+            self.file.close()
+        if os.path.exists(f"{self.path}.tmp"):
+            os.remove(f"{self.path}.tmp")
+
+
+class ParquetShard(NdjsonShard):
+    """
+    Zstandard compressed Parquet part file, with the schema taken from the first batch of rows
+    """
+
+    def __init__(self, path: str):  # pylint: disable=super-init-not-called
+        self.path = path
+        self.docs = 0
+        self.file = None
+
+    def write(self, rows: list):
+        table = pyarrow.Table.from_pylist(rows)
+        if not self.file:
+            self.file = pyarrow.parquet.ParquetWriter(f"{self.path}.tmp", table.schema, compression="zstd")
+        self.file.write_table(table.cast(self.file.schema))
+        self.docs += len(rows)
+
+
+SHARDS = {"ndjson": NdjsonShard, "parquet": ParquetShard}
+
+
+def slice_query(job: dict, sid: int):
+    """
+    Search body of one slice of the point in time, sorted on surt_url with the shard doc tiebreaker
+    """
+    query = cs_basic_query(job["q"] or "*")
+    if not job["q"]:
+        query["query"] = {"match_all": {}}
+    if job["expanded"]:
+        query["_source"] += EXPANDED_SOURCE
+    query.update({
+        "size": job["batch"],
+        "track_total_hits": False,
+        "sort": [{"surt_url": "asc"}, {"_shard_doc": "asc"}]
+    })
+    # Without a field, PIT searches are sliced on _shard_doc, so slices only exist within this point in time
+    if job["slices"] > 1:
+        query["slice"] = {"id": sid, "max": job["slices"]}
+    return query
+
+
+def export_slice(job: dict, outdir: str, pit: dict, sid: int):
+    """
+    Export one slice into part files of about shardsize documents, checkpointing after each completed part
+    """
+    path = os.path.join(outdir, f"slice-{sid:04d}.json")
+    state = read_json(path) or {"slice": sid, "after": None, "docs": 0, "files": [], "done": False}
+    if state["done"]:
+        return state
+    es = Elasticsearch(config["eshosts"], **config["esopts"])
+    query = slice_query(job, sid)
+    # The full sort values are checkpointed, the tiebreaker is what tells apart documents of the same URL
+    after = state["after"]
+    shard = None
+    try:
+        while True:
+            body = {**query, "pit": pit}
+            if after:
+                body["search_after"] = after
+            res = es.search(body=body, params={"filter_path": ",".join(FILTER_PATHS["paged"])})
+            pit = {**pit, "id": res.get("pit_id", pit["id"])}
+            hits = res.get("hits", {}).get("hits", [])
+            if hits:
+                if not shard:
+                    name = f"part-{sid:04d}-{len(state['files']):05d}.{EXTENSIONS[job['format']]}"
+                    shard = SHARDS[job["format"]](os.path.join(outdir, name))
+                shard.write([format_match(h, job["base"], job["collection"], job["expanded"]) for h in hits])
+                after = hits[-1]["sort"]
+            last = len(hits) < job["batch"]
+            if shard and (last or shard.docs >= job["shardsize"]):
+                shard.close()
+                state["files"].append({"name": os.path.basename(shard.path), "docs": shard.docs,
+                                       "bytes": os.path.getsize(shard.path)})
+                state["docs"] += shard.docs
+                state["after"] = after
+                shard = None
+            if last:
+                state["done"] = True
+            write_json(path, state)
+            if last:
+                return state
+    finally:
+        if shard:
+            shard.abort()
+        es.close()
+
+
+def slice_states(job: dict, outdir: str):
+    return [read_json(os.path.join(outdir, f"slice-{sid:04d}.json")) or {} for sid in range(job["slices"])]
+
+
+def export_pit(es, job: dict, outdir: str, keepalive: str):
+    """
+    Point in time of the export, reopened only while no slice has progress tied to the one it was started in
+    """
+    path = os.path.join(outdir, "pit.json")
+    pit = read_json(path)
+    if pit:
+        try:
+            es.search(body={"size": 0, "track_total_hits": False, "pit": {"id": pit["id"], "keep_alive": keepalive}})
+            return pit["id"]
+        except NotFoundError:
+            pass
+    if any(s.get("files") or s.get("done") for s in slice_states(job, outdir)):
+        return None
+    pit = {"id": es.open_point_in_time(index=job["index"], params={"keep_alive": keepalive})["id"]}
+    write_json(path, pit)
+    return pit["id"]
+
+
+def write_manifest(job: dict, outdir: str):
+    states = slice_states(job, outdir)
+    manifest = {
+        **job,
+        "completed": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "docs": sum(s["docs"] for s in states),
+        "files": [{"slice": s["slice"], **f} for s in states for f in s["files"]]
+    }
+    write_json(os.path.join(outdir, "manifest.json"), manifest)
+    return manifest
+
+
+def run(job: dict, outdir: str, workers: int, keepalive: str):
+    """
+    Export the pending slices in parallel worker processes over a shared point in time
+    """
+    pending = [sid for sid, state in enumerate(slice_states(job, outdir)) if not state.get("done")]
+    if not pending:
+        return True
+    es = Elasticsearch(config["eshosts"], **config["esopts"])
+    failed = 0
+    try:
+        pit = export_pit(es, job, outdir, keepalive)
+        if not pit:
+            sys.exit(f"The point in time of the export in {outdir} expired and its slices cannot be resumed in another,"
+                     " remove the directory and start over")
+        with ProcessPoolExecutor(max_workers=min(workers, len(pending))) as pool:
+            futures = {pool.submit(export_slice, job, outdir, {"id": pit, "keep_alive": keepalive}, sid): sid
+                       for sid in pending}
+            for fut in as_completed(futures):
+                try:
+                    state = fut.result()
+                    print(f"slice {futures[fut]}: {state['docs']} docs in {len(state['files'])} files", file=sys.stderr)
+                except (TransportError, OSError) as e:
+                    failed += 1
+                    print(f"slice {futures[fut]} failed: {e}", file=sys.stderr)
+        # An unfinished export keeps its point in time open, the slices can only be resumed in it
+        if not failed:
+            try:
+                es.close_point_in_time(body={"id": pit})
+            except TransportError:
+                pass
+            os.remove(os.path.join(outdir, "pit.json"))
+    finally:
+        es.close()
+    return not failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export a collection or a search result in parallel slices")
+    parser.add_argument("collection", choices=[col.value for col in Collection], help="collection to export")
+    parser.add_argument("output", help="directory of the part files, checkpoints and manifest")
+    parser.add_argument("-q", "--query", default="", help="query_string to export (default: the whole collection)")
+    parser.add_argument("--format", choices=list(SHARDS), default="ndjson", help="format of the part files")
+    parser.add_argument("--slices", type=int, default=8, help="number of slices the export is split into")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="number of parallel worker processes")
+    parser.add_argument("--batch", type=int, default=config["maxpage"], help="documents per search request")
+    parser.add_argument("--shardsize", type=int, default=1000000, help="approximate documents per part file")
+    parser.add_argument("--keepalive", default="1h",
+                        help="how long an interrupted export can be resumed before its point in time expires")
+    parser.add_argument("--expanded", action="store_true", help="include the snippet and other stored fields")
+    parser.add_argument("--base", default=f'{os.getenv("PROXY_BASE", "http://localhost:8000").rstrip("/")}/v1',
+                        help="base URL of the API for article links")
+    args = parser.parse_args()
+
+    if args.format == "parquet" and not pyarrow:
+        parser.error("Parquet output requires the pyarrow package")
+    collection = Collection(args.collection)
+    job = {
+        "collection": collection.value,
+        "index": collection.name,
+        "q": args.query,
+        "format": args.format,
+        "slices": args.slices,
+        "batch": args.batch,
+        "shardsize": args.shardsize,
+        "expanded": args.expanded,
+        "base": args.base
+    }
+    os.makedirs(args.output, exist_ok=True)
+    path = os.path.join(args.output, "job.json")
+    previous = read_json(path)
+    if previous and previous != job:
+        parser.error(f"{args.output} holds an export with different options, resume it with the same options")
+    if not previous:
+        write_json(path, job)
+
+    if not run(job, args.output, args.workers, args.keepalive):
+        sys.exit("Some slices failed, run the same command again to resume the export")
+    manifest = write_manifest(job, args.output)
+    print(json.dumps({k: manifest[k] for k in ("collection", "q", "format", "docs", "completed")}))
+
+
+if __name__ == "__main__":
+    main()
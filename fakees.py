@@ -0,0 +1,263 @@
+#!/usr/bin/env python3
+
+import argparse
+import asyncio
+import bisect
+import itertools
+import operator
+import random
+
+from datetime import date, timedelta
+
+import orjson
+
+from aiohttp import web
+
+
+LANGS = ["en", "es", "fr", "de", "pt", "ar", "ru", "zh", "ja", "hi"]
+TLDS = ["com", "org", "net", "uk", "de", "fr", "es", "in", "br", "au"]
+WORDS = [f"term{i}" for i in range(1000)]
+
+
+def surt(n: int):
+    return f"com,example)/article/{n:012d}"
+
+
+def fake_hit(n: int, sort: list):
+    dom = f"example{n % 250}.{TLDS[n % len(TLDS)]}"
+    return {
+        "_id": f"doc-{n}",
+        "_source": {
+            "title": f"Article number {n} about {WORDS[n % len(WORDS)]}",
+            "snippet": " ".join(WORDS[(n + i) % len(WORDS)] for i in range(60)),
+            "publication_date": f"{2000 + n % 24}-{1 + n % 12:02d}-{1 + n % 28:02d}",
+            "first_captured": f"{2000 + n % 24}{1 + n % 12:02d}{1 + n % 28:02d}120000",
+            "language": LANGS[n % len(LANGS)],
+            "domain": dom,
+            "host": f"www.{dom}",
+            "tld": TLDS[n % len(TLDS)],
+            "url": f"https://www.{dom}/article/{n}",
+            "surt_url": surt(n),
+            "text_extraction_method": "trafilatura",
+            "version": "1.0"
+        },
+        "sort": sort
+    }
+
+
+def epoch_millis(value: str):
+    return (date.fromisoformat(value[:10]) - date(1970, 1, 1)).days * 86400000
+
+
+def date_predicate(node: dict):
+    """
+    Predicate over publication_date buckets (in epoch millis) from the range clauses of a query, ignoring the rest
+    """
+    if "range" in node and "publication_date" in node["range"]:
+        bounds = {op: epoch_millis(v) for op, v in node["range"]["publication_date"].items()}
+        checks = {"gte": operator.ge, "gt": operator.gt, "lte": operator.le, "lt": operator.lt}
+        return lambda k: all(checks[op](k, v) for op, v in bounds.items() if op in checks)
+    clauses = node.get("bool", {})
+    must = [date_predicate(n) for n in clauses.get("must", []) + clauses.get("filter", [])]
+    should = [date_predicate(n) for n in clauses.get("should", [])]
+    must_not = [date_predicate(n) for n in clauses.get("must_not", [])]
+    return lambda k: (all(p(k) for p in must) and (not should or any(p(k) for p in should))
+                      and not any(p(k) for p in must_not))
+
+
+class FakeIndex:
+    """
+    Canned ES responses shaped after the collection index mapping in the README
+    """
+
+    def __init__(self, total: int, years: int):
+        self.total = total
+        end = date.today()
+        days = [end - timedelta(days=i) for i in range(365 * years, -1, -1)]
+        self.histograms = {}
+        for interval, keyfn in {"day": lambda d: d,
+                                "week": lambda d: d - timedelta(days=d.weekday()),
+                                "month": lambda d: d.replace(day=1),
+                                "year": lambda d: d.replace(month=1, day=1)}.items():
+            counts = {}
+            for d in days:
+                counts[keyfn(d)] = counts.get(keyfn(d), 0) + 1 + d.toordinal() % 37
+            self.histograms[interval] = [{"key_as_string": f"{k.isoformat()}T00:00:00.000Z",
+                                          "key": (k - date(1970, 1, 1)).days * 86400000,
+                                          "doc_count": v} for k, v in counts.items()]
+        self.daykeys = [b["key"] for b in self.histograms["day"]]
+        # Open points in time, searches in any other get the 404 of an expired one
+        self.pits = set()
+
+    def terms(self, field: str, size: int):
+        size = min(size, 100)
+        if field in ("title", "snippet"):
+            keys = WORDS[:size]
+        else:
+            keys = {"language": LANGS, "tld": TLDS}.get(field) or [f"example{i}.com" for i in range(size)]
+        return {"buckets": [{"key": k, "doc_count": 10000 // (i + 1)} for i, k in enumerate(keys[:size])]}
+
+    def aggs(self, aggs: dict, keep=lambda key: True, span=(float("-inf"), float("inf"))):
+        res = {}
+        for name, agg in aggs.items():
+            sub = agg.get("aggregations") or agg.get("aggs")
+            if "date_histogram" in agg:
+                res[name] = self.date_histogram(agg["date_histogram"], sub, keep, span)
+            elif "sum" in agg:
+                days = self.histograms["day"][self.days(*span)]
+                res[name] = {"value": float(sum(b["doc_count"] * b["key"] // 86400000 for b in days if keep(b["key"])))}
+            elif "auto_date_histogram" in agg:
+                limit = agg["auto_date_histogram"].get("buckets", 10)
+                interval = next((i for i in ("day", "week", "month") if len(self.histograms[i]) <= limit), "year")
+                res[name] = {"buckets": self.histograms[interval],
+                             "interval": {"day": "1d", "week": "7d", "month": "1M", "year": "1y"}[interval]}
+            elif "sampler" in agg:
+                res[name] = {"doc_count": agg["sampler"].get("shard_size", 100), **self.aggs(sub or {})}
+            else:
+                kind, spec = next(iter(agg.items()))
+                res[name] = self.terms(spec.get("field", ""), 100 if kind == "rare_terms" else spec.get("size", 10))
+        return res
+
+    def date_histogram(self, hist: dict, sub: dict, keep, span: tuple):
+        buckets = self.histograms.get(hist.get("calendar_interval", "day"), self.histograms["day"])
+        # Buckets overlapping the span, which is the parent bucket of a nested histogram
+        buckets = buckets[max(0, bisect.bisect_right(buckets, span[0], key=lambda b: b["key"]) - 1):
+                          bisect.bisect_left(buckets, span[1], key=lambda b: b["key"])]
+        if sub:
+            ends = [b["key"] for b in buckets[1:]] + [float("inf")]
+            buckets = [{**b, **self.aggs(sub, keep, (max(span[0], b["key"]), min(span[1], end)))}
+                       for b, end in zip(buckets, ends)]
+        return {"buckets": self.recount(buckets, keep, span)}
+
+    def days(self, lo: float, hi: float):
+        return slice(bisect.bisect_left(self.daykeys, lo), bisect.bisect_left(self.daykeys, hi))
+
+    def recount(self, buckets: list, keep, span: tuple):
+        """
+        Histogram buckets with the doc counts of the days in the span the date filters keep, dropping empty ones
+        """
+        days = self.histograms["day"]
+        res = []
+        for n, b in enumerate(buckets):
+            end = buckets[n + 1]["key"] if n + 1 < len(buckets) else float("inf")
+            count = sum(d["doc_count"] for d in days[self.days(max(span[0], b["key"]), min(span[1], end))]
+                        if keep(d["key"]))
+            if count:
+                res.append({**b, "doc_count": count})
+        return res
+
+    def search(self, body: dict):
+        size = body.get("size", 10)
+        start = 0
+        if body.get("search_after"):
+            start = int(body["search_after"][0].rsplit("/", 1)[-1]) + 1
+        pit = body.get("pit")
+        docs = range(start, self.total)
+        if body.get("slice"):
+            docs = (n for n in docs if n % body["slice"]["max"] == body["slice"]["id"])
+        hits = [fake_hit(n, [surt(n), n] if pit else [surt(n)]) for n in itertools.islice(docs, size)]
+        res = {"took": 0, "timed_out": False, "_shards": {"total": 1, "successful": 1, "skipped": 0, "failed": 0},
+               "hits": {"max_score": None, "hits": hits}}
+        if body.get("track_total_hits", True) is not False:
+            res["hits"]["total"] = {"value": min(self.total, 10000), "relation": "gte"}
+        if body.get("aggregations") or body.get("aggs"):
+            res["aggregations"] = self.aggs(body.get("aggregations") or body.get("aggs"),
+                                            date_predicate(body.get("query", {})))
+        if pit:
+            res["pit_id"] = pit["id"]
+        return res
+
+    def get(self, eid: str):
+        n = int(eid[4:]) if eid.startswith("doc-") and eid[4:].isdigit() else -1
+        if 0 <= n < self.total:
+            return {"_index": "fake", "found": True, **fake_hit(n, [])}
+        return {"_index": "fake", "_id": eid, "found": False}
+
+
+def build_app(index: FakeIndex, latency: float, jitter: float):
+    async def delay(timeout: str = ""):
+        took = max(0.0, random.gauss(latency, jitter))
+        limit = float(timeout[:-2]) if timeout.endswith("ms") else float("inf")
+        await asyncio.sleep(min(took, limit) / 1000)
+        return int(min(took, limit)), took > limit
+
+    def reply(data: dict, status: int = 200):
+        return web.Response(body=orjson.dumps(data), status=status, content_type="application/json",
+                            headers={"X-Elastic-Product": "Elasticsearch"})
+
+    async def info(_):
+        return reply({"name": "fakees", "version": {"number": "7.17.0", "build_flavor": "default"},
+                      "tagline": "You Know, for Search"})
+
+    async def search(req):
+        body = orjson.loads(await req.read() or b"{}")
+        if body.get("pit") and body["pit"]["id"] not in index.pits:
+            return reply({"error": {"type": "search_context_missing_exception",
+                                    "reason": "No search context found"}, "status": 404}, 404)
+        took, timed_out = await delay(body.get("timeout", ""))
+        return reply({**index.search(body), "took": took, "timed_out": timed_out})
+
+    async def msearch(req):
+        lines = [orjson.loads(ln) for ln in (await req.read()).splitlines() if ln.strip()]
+        took, timed_out = await delay(lines[1].get("timeout", "") if len(lines) > 1 else "")
+        return reply({"took": took, "responses": [{**index.search(b), "took": took, "timed_out": timed_out,
+                                                   "status": 200} for b in lines[1::2]]})
+
+    async def count(_):
+        await delay()
+        return reply({"count": index.total, "_shards": {"total": 1, "successful": 1}})
+
+    async def get(req):
+        await delay()
+        doc = index.get(req.match_info["id"])
+        return reply(doc, 200 if doc["found"] else 404)
+
+    async def mget(req):
+        body = orjson.loads(await req.read())
+        await delay()
+        return reply({"docs": [index.get(eid) for eid in body["ids"]]})
+
+    async def open_pit(_):
+        await delay()
+        pit = f"fakepit-{random.getrandbits(64):x}"
+        index.pits.add(pit)
+        return reply({"id": pit})
+
+    async def close_pit(req):
+        index.pits.discard(orjson.loads(await req.read() or b"{}").get("id"))
+        return reply({"succeeded": True, "num_freed": 1})
+
+    async def stats(_):
+        return reply({"_all": {"primaries": {"docs": {"count": index.total, "deleted": 0},
+                                             "indexing": {"index_total": index.total, "delete_total": 0},
+                                             "refresh": {"total": 1}}}})
+
+    app = web.Application(client_max_size=64 * 1024 * 1024)
+    app.add_routes([
+        web.get("/", info),
+        web.route("*", "/_search", search),
+        web.route("*", "/{index}/_search", search),
+        web.route("*", "/{index}/_msearch", msearch),
+        web.route("*", "/_msearch", msearch),
+        web.route("*", "/{index}/_count", count),
+        web.get("/{index}/_doc/{id}", get),
+        web.route("*", "/{index}/_mget", mget),
+        web.post("/{index}/_pit", open_pit),
+        web.delete("/_pit", close_pit),
+        web.get("/{index}/_stats", stats),
+        web.get("/{index}/_stats/{metric}", stats)
+    ])
+    return app
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="A local Elasticsearch stand-in with canned collection responses")
+    parser.add_argument("--host", default="127.0.0.1", help="interface to listen on")
+    parser.add_argument("--port", type=int, default=9200, help="port to listen on")
+    parser.add_argument("--latency", type=float, default=20, help="mean response latency in milliseconds")
+    parser.add_argument("--jitter", type=float, default=5, help="standard deviation of the latency in milliseconds")
+    parser.add_argument("--hits", type=int, default=20000, help="number of documents matching every query")
+    parser.add_argument("--years", type=int, default=20, help="years of daily histogram buckets")
+    args = parser.parse_args()
+
+    web.run_app(build_app(FakeIndex(args.hits, args.years), args.latency, args.jitter), host=args.host, port=args.port)
@@ -0,0 +1,94 @@
+import hashlib
+
+from elasticsearch.exceptions import TransportError
+from fastapi import Depends, HTTPException, Request
+
+from utils import decode_resume, normalize_query
+
+
+DEFAULT_CACHE_CONTROL = {
+    "overview": "public, max-age=60",
+    "count": "public, max-age=60",
+    "dashboard": "public, max-age=60",
+    "terms": "public, max-age=300",
+    "result": "public, max-age=60",
+    "article": "public, max-age=3600"
+}
+
+GENERATION_PATHS = ["_all.primaries.docs.count", "_all.primaries.docs.deleted",
+                    "_all.primaries.indexing.index_total", "_all.primaries.indexing.delete_total"]
+
+
+def etag_matches(header: str, etag: str):
+    # Weak comparison, as If-None-Match requires, so W/ prefixes are ignored on both sides
+    tags = [t.strip().removeprefix("W/") for t in header.split(",")]
+    return "*" in tags or etag.removeprefix("W/") in tags
+
+
+def pit_request(req: Request):
+    """
+    Whether a result page is read from a point in time, opened by this request or carried in its resume token
+    """
+    if req.query_params.get("pit", "").lower() in ("true", "1", "yes", "on"):
+        return True
+    resume = req.query_params.get("resume")
+    try:
+        return bool(resume) and "pit" in decode_resume(resume)
+    except ValueError:
+        # Malformed tokens are rejected by the search itself
+        return False
+
+
+class HttpCache:
+    """
+    ETag validators derived from a cached generation marker of each index, answering conditional GETs with 304
+    """
+
+    def __init__(self, es, cache, ttl: int, indexes: dict, cachecontrol: dict):
+        self.es = es
+        self.cache = cache
+        self.ttl = ttl
+        self.indexes = indexes
+        self.cachecontrol = cachecontrol
+
+    async def generation(self, index: str):
+        # A failed lookup is not cached, so validators come back as soon as the stats do
+        return await self.cache.get_or_set(("generation", index), self.ttl, lambda: self._fetch_generation(index),
+                                           keep=lambda g: g is not None)
+
+    async def _fetch_generation(self, index: str):
+        try:
+            res = await self.es.indices.stats(index=index, metric="docs,indexing",
+                                              params={"filter_path": ",".join(GENERATION_PATHS)})
+        except TransportError:
+            # E.g. the ES user lacks the monitor privilege, then responses are served without validators
+            return None
+        prim = res["_all"]["primaries"]
+        return "-".join(str(v) for v in (prim["docs"]["count"], prim["docs"]["deleted"],
+                                          prim["indexing"]["index_total"], prim["indexing"]["delete_total"]))
+
+    @staticmethod
+    def etag(generation: str, req: Request, variant: str):
+        params = sorted((k, normalize_query(v) if k == "q" else v) for k, v in req.query_params.multi_items())
+        key = repr((generation, req.url.path, params, variant))
+        return f'W/"{hashlib.blake2b(key.encode(), digest_size=12).hexdigest()}"'
+
+    def dependencies(self, kind: str):
+        """
+        Route dependencies that set the validators of a GET response, or end the request early with 304 Not Modified
+        """
+        async def validate(collection: str, req: Request):
+            cachecontrol = self.cachecontrol.get(kind)
+            # Point in time pages are tied to a short-lived search context and must not be reused
+            if collection not in self.indexes or not cachecontrol or pit_request(req):
+                return
+            # Responses are negotiated between JSON and MessagePack, so each gets its own validator
+            variant = "msgpack" if "msgpack" in req.headers.get("accept", "") else "json"
+            generation = await self.generation(self.indexes[collection])
+            if generation is None:
+                return
+            validators = {"etag": self.etag(generation, req, variant), "cache-control": cachecontrol}
+            if etag_matches(req.headers.get("if-none-match", ""), validators["etag"]):
+                raise HTTPException(status_code=304, headers={**validators, "vary": "Accept"})
+            req.state.validators = validators
+        return [Depends(validate)]
@@ -0,0 +1,198 @@
+import functools
+import time
+
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from elasticsearch import AsyncTransport
+from elasticsearch.exceptions import ConnectionTimeout, TransportError
+from prometheus_client import Counter, Gauge, Histogram
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily, REGISTRY
+
+
+REQUEST = ContextVar("REQUEST", default=None)
+# Seconds spent in each phase of the current request, reported in its Server-Timing header
+TIMINGS = ContextVar("TIMINGS", default=None)
+PHASE = ContextVar("PHASE", default=None)
+
+REQUEST_SECONDS = Histogram("colsearch_request_seconds", "End-to-end request latency",
+                            ["route", "collection", "method", "status"])
+RESPONSE_BYTES = Histogram("colsearch_response_bytes", "Response body size", ["route", "collection"],
+                           buckets=(256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216))
+IN_FLIGHT = Gauge("colsearch_requests_in_flight", "Requests currently being served")
+ES_SECONDS = Histogram("colsearch_es_request_seconds", "ES round trip time as seen by the API",
+                       ["route", "collection", "endpoint"])
+ES_TOOK_SECONDS = Histogram("colsearch_es_took_seconds", "ES reported query execution time",
+                            ["route", "collection", "endpoint"])
+ES_ERRORS = Counter("colsearch_es_errors_total", "ES errors and timeouts", ["route", "collection", "endpoint", "error"])
+QUERY_ACTIONS = Counter("colsearch_query_actions_total", "Query cost guard decisions", ["action"])
+ES_HEDGES = Counter("colsearch_es_hedges_total", "Hedged ES reads sent and won by the duplicate",
+                    ["endpoint", "outcome"])
+FORMAT_SECONDS = Histogram("colsearch_format_seconds", "Time spent formatting ES responses",
+                           ["route", "collection"],
+                           buckets=(0.0001, 0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0))
+
+
+def request_labels():
+    ctx = REQUEST.get()
+    if not ctx:
+        return "", ""
+    mware, scope = ctx
+    route = scope.get("route")
+    collection = scope.get("path_params", {}).get("collection", "")
+    return getattr(route, "path", "other"), collection if collection in mware.collections else ""
+
+
+def es_endpoint(url: str):
+    # Keep only the API name of the path (e.g., _search, _msearch, _doc) to bound label cardinality
+    parts = [p for p in url.split("?")[0].split("/") if p.startswith("_")]
+    return parts[0] if parts else "/"
+
+
+def add_timing(phase: str, seconds: float):
+    timings = TIMINGS.get()
+    if timings is not None:
+        timings[phase] = timings.get(phase, 0.0) + seconds
+
+
+@contextmanager
+def timing(phase: str):
+    # Nested calls within the same phase (e.g., query builders calling each other) are only counted once
+    if PHASE.get() == phase:
+        yield
+        return
+    token = PHASE.set(phase)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        add_timing(phase, time.perf_counter() - start)
+        PHASE.reset(token)
+
+
+def timed(phase: str):
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with timing(phase):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+@contextmanager
+def formatting():
+    start = time.perf_counter()
+    with timing("format"):
+        yield
+    FORMAT_SECONDS.labels(*request_labels()).observe(time.perf_counter() - start)
+
+
+class InstrumentedTransport(AsyncTransport):
+    """
+    ES transport that records round trip time, reported took time and errors per API route
+    """
+
+    async def perform_request(self, method, url, headers=None, params=None, body=None):
+        labels = (*request_labels(), es_endpoint(url))
+        start = time.perf_counter()
+        try:
+            res = await super().perform_request(method, url, headers=headers, params=params, body=body)
+        except ConnectionTimeout:
+            ES_ERRORS.labels(*labels, "timeout").inc()
+            raise
+        except TransportError as e:
+            ES_ERRORS.labels(*labels, str(e.status_code)).inc()
+            raise
+        finally:
+            ES_SECONDS.labels(*labels).observe(time.perf_counter() - start)
+            add_timing("es", time.perf_counter() - start)
+        if isinstance(res, dict) and "took" in res:
+            ES_TOOK_SECONDS.labels(*labels).observe(res["took"] / 1000)
+            add_timing("took", res["took"] / 1000)
+        return res
+
+
+class MetricsMiddleware:  # pylint: disable=too-few-public-methods
+    """
+    ASGI middleware that records request latency, response size and in-flight requests
+    """
+
+    def __init__(self, app, collections: list):
+        self.app = app
+        self.collections = set(collections)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        token = REQUEST.set((self, scope))
+        resp = {"status": 500, "size": 0}
+
+        async def send_wrapper(msg):
+            if msg["type"] == "http.response.start":
+                resp["status"] = msg["status"]
+            elif msg["type"] == "http.response.body":
+                resp["size"] += len(msg.get("body", b""))
+            await send(msg)
+
+        IN_FLIGHT.inc()
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            IN_FLIGHT.dec()
+            route, collection = request_labels()
+            REQUEST_SECONDS.labels(route, collection, scope["method"], str(resp["status"])).observe(
+                time.perf_counter() - start)
+            RESPONSE_BYTES.labels(route, collection).observe(resp["size"])
+            REQUEST.reset(token)
+
+
+class CacheCollector:  # pylint: disable=too-few-public-methods
+    """
+    Exposes the counters of a ResultCache at scrape time
+    """
+
+    def __init__(self, cache):
+        self.cache = cache
+
+    def collect(self):
+        stats = self.cache.stats()
+        for name in ("hits", "misses", "coalesced", "evictions", "expirations"):
+            yield CounterMetricFamily(f"colsearch_cache_{name}", f"Result cache {name}", value=stats[name])
+        yield GaugeMetricFamily("colsearch_cache_entries", "Result cache entries", value=stats["entries"])
+        yield GaugeMetricFamily("colsearch_cache_bytes", "Result cache approximate size", value=stats["bytes"])
+
+
+def register_cache(cache):
+    REGISTRY.register(CacheCollector(cache))
+
+
+class AdmissionCollector:  # pylint: disable=too-few-public-methods
+    """
+    Exposes the occupancy and queue depth of admission gates at scrape time
+    """
+
+    def __init__(self, admission):
+        self.admission = admission
+
+    def collect(self):
+        labels = ["collection", "class"]
+        active = GaugeMetricFamily("colsearch_admission_active", "Requests holding an admission slot", labels=labels)
+        queued = GaugeMetricFamily("colsearch_admission_queued", "Requests waiting for an admission slot",
+                                   labels=labels)
+        rejected = CounterMetricFamily("colsearch_admission_rejected", "Requests shed by admission control",
+                                       labels=[*labels, "status"])
+        for (col, kind), gate in list(self.admission.gates.items()):
+            active.add_metric([col, kind], gate.active)
+            queued.add_metric([col, kind], len(gate.waiters))
+            for status, count in gate.rejected.items():
+                rejected.add_metric([col, kind, str(status)], count)
+        yield active
+        yield queued
+        yield rejected
+
+
+def register_admission(admission):
+    REGISTRY.register(AdmissionCollector(admission))
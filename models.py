@@ -0,0 +1,64 @@
+from datetime import date
+from enum import Enum
+from typing import List, Union
+
+from pydantic import BaseModel, Field
+
+from settings import config
+from utils import list_to_enum
+
+
+Collection = list_to_enum("Collection", config["indexes"])
+TermField = list_to_enum("TermField", config["termfields"])
+TermAggr = list_to_enum("TermAggr", config["termaggrs"])
+
+
+class Query(BaseModel):
+    q: str
+
+
+class Interval(str, Enum):
+    day = "day"
+    week = "week"
+    month = "month"
+    auto = "auto"
+
+
+class Facet(str, Enum):
+    daily = "daily"
+    lang = "lang"
+    domain = "domain"
+    tld = "tld"
+
+
+class OverviewQuery(Query):
+    start: Union[date, None] = None
+    end: Union[date, None] = None
+    interval: Interval = Interval.day
+    facets: List[Facet] = list(Facet)
+    facetsize: int = Field(100, ge=1, le=config["maxbuckets"])
+    size: int = Field(10, ge=0, le=config["maxpage"])
+
+
+class FederatedQuery(OverviewQuery):
+    collections: List[Collection] = Field(list(Collection), min_length=1)
+
+
+class PagedQuery(Query):
+    resume: Union[str, None] = None
+    pit: bool = False
+    prefetch: bool = False
+
+
+class ArticleIds(BaseModel):
+    ids: List[str]
+
+
+class ExportFormat(str, Enum):
+    ndjson = "ndjson"
+    csv = "csv"
+
+
+class ExportQuery(Query):
+    format: ExportFormat = ExportFormat.ndjson
+    pit: bool = False
@@ -0,0 +1,243 @@
+from datetime import date, timedelta
+from typing import Union
+
+from elasticsearch.exceptions import TransportError
+
+from metrics import timed
+from models import Facet, Interval, OverviewQuery
+from queries import FACET_FIELDS, cs_basic_query, cs_budget, cs_histogram, cs_msearch, cs_overview_query
+from queries import request_timeout, result_partial
+from utils import normalize_query
+
+
+# Upper bound of the buckets of one partition search, well below the search.max_buckets default of 65535
+PARTITION_BUCKETS = 20000
+
+FINGERPRINT_QUERY = {
+    "size": 0,
+    "track_total_hits": False,
+    "aggregations": {
+        "months": {
+            "date_histogram": {
+                "field": "publication_date",
+                "calendar_interval": "month",
+                "min_doc_count": 1
+            },
+            "aggregations": {
+                "seqno": {
+                    "sum": {
+                        "field": "_seq_no"
+                    }
+                }
+            }
+        }
+    }
+}
+FINGERPRINT_PATHS = [f"aggregations.months.buckets.{key}" for key in ("key_as_string", "doc_count", "seqno.value")]
+
+
+def add_months(d: date, n: int):
+    year, month = divmod(d.month - 1 + n, 12)
+    return date(d.year + year, month + 1, 1)
+
+
+def closed_span(start: Union[date, None], end: Union[date, None], recent: int):
+    """
+    Whole months within the requested dates that precede the current and recent months still receiving captures
+    """
+    lo = add_months(start - timedelta(days=1), 1) if start else None
+    hi = add_months(date.today(), -recent)
+    if end:
+        hi = min(hi, (end + timedelta(days=1)).replace(day=1))
+    return lo, hi
+
+
+def month_ranges(months: list):
+    """
+    Collapse sorted months into the fewest contiguous publication_date range filters
+    """
+    spans = []
+    for month in map(date.fromisoformat, months):
+        if spans and spans[-1][1] == month:
+            spans[-1][1] = add_months(month, 1)
+        else:
+            spans.append([month, add_months(month, 1)])
+    return [{"range": {"publication_date": {"gte": lo.isoformat(), "lt": hi.isoformat()}}} for lo, hi in spans]
+
+
+def merge_buckets(parts: list, key: str, size: Union[int, None] = None):
+    """
+    Sum the doc counts of equal bucket keys, keeping the size largest, or all of them in key order
+    """
+    counts = {}
+    for buckets in parts:
+        for bucket in buckets:
+            counts[bucket[key]] = counts.get(bucket[key], 0) + bucket["doc_count"]
+    items = sorted(counts.items(), key=lambda kv: -kv[1])[:size] if size else sorted(counts.items())
+    return [{key: k, "doc_count": v} for k, v in items]
+
+
+def bucket_key(facet: str):
+    return "key_as_string" if facet == Facet.daily.value else "key"
+
+
+def exclude_months(query: dict, lo: Union[date, None], hi: date):
+    bounds = {op: d.isoformat() for op, d in (("gte", lo), ("lt", hi)) if d}
+    query["query"] = {"bool": {"must": [query["query"]], "must_not": [{"range": {"publication_date": bounds}}]}}
+    return query
+
+
+def part_facetsize(facetsize: int):
+    # A month is only a piece of the merged top terms, so it keeps more than its share, as ES sizes shard_size
+    return int(facetsize * 1.5 + 10)
+
+
+def cs_partition_query(payload: OverviewQuery, months: list):
+    """
+    All facets of the given months, each in its own bucket, regardless of the facets requested
+    """
+    query = cs_basic_query(payload.q)
+    ranges = {"bool": {"should": month_ranges(months), "minimum_should_match": 1}}
+    query["query"] = {"bool": {"must": [query["query"]], "filter": [ranges]}}
+    aggs = {Facet.daily.value: cs_histogram(payload.interval.value)}
+    for facet, field in FACET_FIELDS.items():
+        aggs[facet] = {"terms": {"field": field, "size": part_facetsize(payload.facetsize)}}
+    query.update({"size": 0, "track_total_hits": False, "_source": False})
+    query["aggregations"] = {
+        "partitions": {
+            "date_histogram": {
+                "field": "publication_date",
+                "calendar_interval": "month",
+                "min_doc_count": 1
+            },
+            "aggregations": aggs
+        }
+    }
+    return query
+
+
+class PartitionCache:
+    """
+    Aggregations of closed months of publication_date cached per query, merged with a live search of the rest
+
+    Each month is fingerprinted by its document count and the sum of its sequence numbers,
+    so that reindexing any document of a month invalidates the cached results of that month.
+    """
+
+    def __init__(self, es, cache, settings: dict, checkttl: float):
+        self.es = es
+        self.cache = cache
+        self.enabled = str(settings["enabled"]).lower() in ("true", "1", "t")
+        self.recent = int(settings["recent"])
+        self.ttl = float(settings["ttl"])
+        self.checkttl = checkttl
+
+    async def fingerprints(self, index: str):
+        return await self.cache.get_or_set(("fingerprints", index), self.checkttl, lambda: self._fingerprints(index))
+
+    async def _fingerprints(self, index: str):
+        params = {"filter_path": ",".join(FINGERPRINT_PATHS), "request_cache": "true"}
+        try:
+            res = await self.es.search(index=index, body=FINGERPRINT_QUERY, params=params)
+        except TransportError:
+            # Without fingerprints no month can be trusted, so overviews are searched in full until the next check
+            return {}
+        buckets = res.get("aggregations", {}).get("months", {}).get("buckets", [])
+        return {b["key_as_string"][:10]: f'{b["doc_count"]}-{int(b["seqno"]["value"] or 0)}' for b in buckets}
+
+    def usable(self, payload: OverviewQuery):
+        # The auto interval is picked over the whole range, so per month histograms would not line up
+        return self.enabled and payload.facets and payload.interval != Interval.auto
+
+    async def search(self, index: str, payload: OverviewQuery):
+        """
+        Overview search response assembled from cached and recomputed months, or None when it cannot be partitioned
+        """
+        lo, hi = closed_span(payload.start, payload.end, self.recent)
+        months = {m: fp for m, fp in (await self.fingerprints(index)).items()
+                  if (not lo or m >= lo.isoformat()) and m < hi.isoformat()}
+        if not months:
+            return None
+        qkey = ("partition", index, normalize_query(payload.q), payload.interval.value, payload.facetsize)
+        parts = {m: self.cache.peek((*qkey, m)) for m in months}
+        parts = {m: part for m, part in parts.items() if part and part["fingerprint"] == months[m]}
+        searches = partition_searches(payload, lo, hi, sorted(set(months) - set(parts)))
+        responses = await self._msearch(index, payload, searches)
+        found = {"partial": any(result_partial(sres) for sres in responses)}
+        for (name, _, chunk), sres in zip(searches, responses):
+            found[name] = sres
+            if chunk:
+                self._update(parts, qkey, months, sres, chunk)
+        return merge_partitions(payload, found, list(parts.values()))
+
+    async def _msearch(self, index: str, payload: OverviewQuery, searches: list):
+        msearch = cs_msearch(payload.q, [cs_budget(query, "overview") for _, query, _ in searches])
+        msearch["params"]["filter_path"] += ",responses.aggregations.partitions"
+        msearch["params"]["request_timeout"] = request_timeout("overview")
+        res = await self.es.msearch(index=index, **msearch)
+        for sres in res["responses"]:
+            if "error" in sres:
+                raise TransportError(sres.get("status", 500), "search_phase_execution_exception", sres["error"])
+        return res["responses"]
+
+    def _update(self, parts: dict, qkey: tuple, months: dict, sres: dict, chunk: list):  # pylint: disable=too-many-arguments,too-many-positional-arguments
+        for m, part in month_parts(sres, chunk):
+            parts[m] = {"fingerprint": months[m], **part}
+            # Results cut short by the latency budget are served once but never cached
+            if not result_partial(sres):
+                self.cache.put((*qkey, m), self.ttl, parts[m])
+
+
+@timed("query")
+def partition_searches(payload: OverviewQuery, lo: Union[date, None], hi: date, missing: list):
+    """
+    Named searches of the live range outside the closed months, the top hits, and chunks of months to recompute
+    """
+    live = exclude_months(cs_overview_query(payload), lo, hi)
+    live.update({"size": 0, "_source": False})
+    for agg in live.get("aggregations", {}).values():
+        if "terms" in agg:
+            agg["terms"]["size"] = part_facetsize(payload.facetsize)
+    searches = [("live", live, None)]
+    if payload.size:
+        hits = cs_basic_query(payload.q, payload.start, payload.end)
+        hits.update({"size": payload.size, "track_total_hits": False})
+        searches.append(("hits", hits, None))
+    step = max(1, PARTITION_BUCKETS // (31 + len(FACET_FIELDS) * part_facetsize(payload.facetsize)))
+    for i in range(0, len(missing), step):
+        searches.append(("partitions", cs_partition_query(payload, missing[i:i + step]), missing[i:i + step]))
+    return searches
+
+
+def month_parts(sres: dict, months: list):
+    buckets = sres.get("aggregations", {}).get("partitions", {}).get("buckets", [])
+    buckets = {b["key_as_string"][:10]: b for b in buckets}
+    for m in months:
+        # Months without a bucket have no matches, which is as worth caching as any count
+        bucket = buckets.get(m, {})
+        part = {"doc_count": bucket.get("doc_count", 0)}
+        for facet in (Facet.daily.value, *FACET_FIELDS):
+            key = bucket_key(facet)
+            part[facet] = [{key: b[key], "doc_count": b["doc_count"]} for b in bucket.get(facet, {}).get("buckets", [])]
+        yield m, part
+
+
+def merge_partitions(payload: OverviewQuery, found: dict, parts: list):
+    """
+    Search response shaped like that of the overview query, with the live and month buckets summed
+    """
+    live = found["live"]
+    aggs = {}
+    for facet in payload.facets:
+        buckets = [part[facet.value] for part in parts]
+        buckets.append(live.get("aggregations", {}).get(facet.value, {}).get("buckets", []))
+        size = None if facet == Facet.daily else payload.facetsize
+        aggs[facet.value] = {"buckets": merge_buckets(buckets, bucket_key(facet.value), size)}
+    return {
+        "timed_out": found["partial"],
+        "hits": {
+            "total": {"value": live["hits"]["total"]["value"] + sum(part["doc_count"] for part in parts)},
+            "hits": found.get("hits", {}).get("hits", {}).get("hits", [])
+        },
+        "aggregations": aggs
+    }
@@ -0,0 +1,237 @@
+import hashlib
+
+from datetime import date
+from typing import Union
+
+from metrics import timed
+from models import Facet, OverviewQuery
+from querycost import QueryGuard
+from settings import config
+from utils import decode_resume, encode, normalize_query
+
+
+GUARD = QueryGuard(config["querycost"])
+
+
+def cs_basic_query(q: str, start: Union[date, None] = None, end: Union[date, None] = None):
+    query = {
+        "_source": [
+            "title",
+            "publication_date",
+            "language",
+            "domain",
+            "url",
+            "first_captured"
+        ],
+        "query": {
+            "query_string": {
+                "default_field": "snippet",
+                "default_operator": "AND",
+                "allow_leading_wildcard": config["querycost"]["leadingwildcard"],
+                "query": GUARD.plan(q).query
+            }
+        }
+    }
+    if start or end:
+        bounds = {op: d.isoformat() for op, d in (("gte", start), ("lte", end)) if d}
+        query["query"] = {
+            "bool": {
+                "must": [query["query"]],
+                "filter": [{"range": {"publication_date": bounds}}]
+            }
+        }
+    return query
+
+
+def cs_histogram(interval: str = "day"):
+    if interval == "auto":
+        return {
+            "auto_date_histogram": {
+                "field": "publication_date",
+                "buckets": config["maxbuckets"],
+                "minimum_interval": "day"
+            }
+        }
+    return {
+        "date_histogram": {
+            "field": "publication_date",
+            "calendar_interval": interval,
+            "min_doc_count": 1
+        }
+    }
+
+
+FACET_FIELDS = {"lang": "language", "domain": "domain", "tld": "tld"}
+
+
+@timed("query")
+def cs_overview_query(payload: OverviewQuery):
+    query = cs_basic_query(payload.q, payload.start, payload.end)
+    aggs = {}
+    for facet in payload.facets:
+        if facet == Facet.daily:
+            aggs["daily"] = cs_histogram(payload.interval.value)
+        else:
+            aggs[facet.value] = {
+                "terms": {
+                    "field": FACET_FIELDS[facet.value],
+                    "size": payload.facetsize
+                }
+            }
+    query["size"] = payload.size
+    if not payload.size:
+        query["_source"] = False
+    if aggs:
+        query["aggregations"] = aggs
+    return query
+
+
+@timed("query")
+def cs_terms_query(q: str, field: str = "title", aggr: str = "top",
+                   start: Union[date, None] = None, end: Union[date, None] = None):
+    resct = 200
+    aggr_map = {
+        "top": {
+            "terms": {
+                "field": field,
+                "size": resct,
+                "min_doc_count": 10,
+                "shard_min_doc_count": 5
+            }
+        },
+        "significant": {
+            "significant_terms": {
+                "field": field,
+                "size": resct,
+                "min_doc_count": 10,
+                "shard_min_doc_count": 5
+            }
+        },
+        "rare": {
+            "rare_terms": {
+                "field": field,
+                "exclude": "[0-9].*"
+            }
+        }
+    }
+    query = cs_basic_query(q, start, end)
+    query.update({
+        "size": 0,
+        "track_total_hits": False,
+        "_source": False,
+        "aggregations": {
+            "sample": {
+                "sampler": {
+                    "shard_size": 10 if aggr == "rare" else 500
+                },
+                "aggregations": {
+                    "topterms": aggr_map[aggr]
+                }
+            }
+        }
+    })
+    return query
+
+
+# Budget (in seconds) at or above which term aggregations sample the full shard_size
+SAMPLER_BUDGET = 5
+
+
+@timed("query")
+def cs_budget(query: dict, name: str):
+    """
+    Bound the ES execution of a query by the latency budget of an endpoint, collecting partial results on expiry
+    """
+    budget = config["budgets"][name]
+    query["timeout"] = f"{int(budget * 1000)}ms"
+    if config["terminateafter"].get(name):
+        query["terminate_after"] = config["terminateafter"][name]
+    sampler = query.get("aggregations", {}).get("sample", {}).get("sampler")
+    if sampler and budget < SAMPLER_BUDGET:
+        size = sampler["shard_size"]
+        sampler["shard_size"] = max(size // 10, int(size * budget / SAMPLER_BUDGET))
+    return query
+
+
+def request_timeout(name: str):
+    # Leave ES room to return what it collected before the client gives up on the request
+    return config["budgets"][name] * 2
+
+
+@timed("query")
+def cs_paged_query(q: str, resume: Union[str, None] = None, pit: Union[str, None] = None):
+    query = cs_basic_query(q)
+    query.update({
+        "size": config["maxpage"],
+        "track_total_hits": False,
+        "sort": [{"surt_url": "asc"}]
+    })
+    if resume:
+        token = decode_resume(resume)
+        pit = token.get("pit", pit)
+        query["search_after"] = token["sort"]
+    if pit:
+        query["pit"] = {"id": pit, "keep_alive": config["pitkeepalive"]}
+        query["sort"].append({"_shard_doc": "asc"})
+    return query
+
+
+HIT_PATHS = ["hits.hits._id", "hits.hits._source"]
+BUCKET_PATHS = [f"aggregations.*.buckets.{key}" for key in ("key", "key_as_string", "doc_count")]
+PARTIAL_PATHS = ["timed_out", "terminated_early", "_shards.failed"]
+FILTER_PATHS = {
+    "overview": ["took", *PARTIAL_PATHS, "hits.total.value", *HIT_PATHS, *BUCKET_PATHS, "aggregations.daily.interval"],
+    "terms": ["took", *PARTIAL_PATHS, *(f"aggregations.sample.topterms.buckets.{key}" for key in ("key", "doc_count"))],
+    "paged": ["took", *HIT_PATHS, "hits.hits.sort", "pit_id"],
+    "get": ["_id", "_source"],
+    "mget": ["docs._id", "docs._source", "docs.found"]
+}
+
+
+def result_partial(res: dict):
+    return bool(res.get("timed_out") or res.get("terminated_early") or res.get("_shards", {}).get("failed"))
+
+
+def format_match(hit: dict, base: str, collection: str, expanded: bool = False):
+    src = hit["_source"]
+    ct = src.get("first_captured") or "19700101000000"
+    res = {
+        "title": src.get("title") or "[UNKNOWN]",
+        "publication_date": (src.get("publication_date") or "")[:10],
+        "capture_time": f"{ct[:4]}-{ct[4:6]}-{ct[6:8]}T{ct[8:10]}:{ct[10:12]}:{ct[12:14]}Z",
+        "language": src.get("language") or "",
+        "domain": src["domain"],
+        "url": src["url"],
+        "original_capture_url": f"{config['wayback']}/{ct}id_/{src['url']}",
+        "archive_playback_url": f"{config['wayback']}/{ct}/{src['url']}",
+        "article_url": f"{base}/{collection}/article/{encode(hit['_id'])}"
+    }
+    if expanded:
+        res["surt_url"] = src["surt_url"]
+        res["snippet"] = src.get("snippet", "")
+        res["text_extraction_method"] = src.get("text_extraction_method", "")
+        res["version"] = src.get("version", "")
+    return res
+
+
+@timed("query")
+def cs_search_params(q: str, query: dict, paths: list):
+    params = {"filter_path": ",".join(paths)}
+    # ES rejects preference on PIT searches, which are pinned to their shard copies anyway
+    if "pit" not in query:
+        params["preference"] = hashlib.blake2b(normalize_query(q).encode(), digest_size=8).hexdigest()
+    if query.get("size") == 0:
+        params["request_cache"] = "true"
+    return params
+
+
+@timed("query")
+def cs_msearch(q: str, queries: list):
+    body = []
+    for query in queries:
+        header = cs_search_params(q, query, [])
+        del header["filter_path"]
+        body += [header, query]
+    # status is kept so that filtering never drops a response and shifts the positions of the rest
+    paths = ["status", "error.type", "error.reason", *FILTER_PATHS["overview"], *FILTER_PATHS["terms"]]
+    return {"body": body, "params": {"filter_path": ",".join(["took", *(f"responses.{p}" for p in paths)])}}
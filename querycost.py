@@ -0,0 +1,199 @@
+import functools
+import re
+
+from typing import NamedTuple
+
+from fastapi import HTTPException, Request
+
+from metrics import QUERY_ACTIONS, timed
+
+
+QUERY_PARTS = re.compile(r"""
+    (?P<field>[\w.*]+:)?
+    (?:
+        (?P<phrase>"(?:\\.|[^"\\])*")(?:~(?P<slop>\d+))?
+      | (?P<range>[\[{](?:\\.|[^\]}\\])*[\]}])
+      | (?P<regex>/(?:\\.|[^/\\])*/)
+      | (?P<open>\()
+      | (?P<close>\))
+      | (?P<term>[^\s()"]+)
+    )""", re.X)
+BOOLEANS = {"AND", "OR", "NOT", "&&", "||", "!"}
+SPECIAL = re.compile(r'([*?~/])')
+
+# Rough relative cost of query_string features, calibrated so that a plain term costs 1
+COST_WEIGHTS = {
+    "term": 1,
+    "wildcard": 20,
+    "leading": 500,
+    "regex": 200,
+    "regexchar": 5,
+    "fuzzy": 50,
+    "slop": 2,
+    "depth": 10
+}
+
+DEFAULT_LIMITS = {
+    "reject": 5000,
+    "downgrade": 1000,
+    "maxterms": 100,
+    "maxdepth": 10,
+    "maxslop": 20,
+    "maxfuzzy": 1,
+    "leadingwildcard": False
+}
+
+
+class QueryFeatures(NamedTuple):
+    terms: int
+    wildcards: int
+    leading: int
+    regexes: int
+    regexchars: int
+    fuzzy: int
+    slop: int
+    depth: int
+
+
+class QueryPlan(NamedTuple):
+    query: str
+    cost: int
+    action: str
+    reason: str
+
+
+def split_term(term: str):
+    """
+    Split a bare query_string term into its operator prefix, body, fuzziness suffix and boost suffix
+    """
+    prefix = term[:1] if term[:1] in "+-!" and len(term) > 1 else ""
+    body, boost = term[len(prefix):], ""
+    if "^" in body and body.rsplit("^", 1)[1].replace(".", "", 1).isdigit():
+        body, boost = body.rsplit("^", 1)
+        boost = f"^{boost}"
+    fuzzy = None
+    if "~" in body and not body.endswith("\\~"):
+        body, fuzzy = body.rsplit("~", 1)
+    return prefix, body, fuzzy, boost
+
+
+def fuzzy_edits(fuzzy: str):
+    # A bare ~ means AUTO fuzziness, which allows up to two edits
+    return min(2, int(fuzzy)) if fuzzy.isdigit() else 2
+
+
+def analyze_query(q: str):
+    counts = dict.fromkeys(QueryFeatures._fields, 0)
+    depth = 0
+    for m in QUERY_PARTS.finditer(q):
+        if m["open"]:
+            depth += 1
+            counts["depth"] = max(counts["depth"], depth)
+        elif m["close"]:
+            depth = max(0, depth - 1)
+        elif m["phrase"]:
+            counts["terms"] += len(m["phrase"][1:-1].split())
+            counts["slop"] += int(m["slop"] or 0)
+        elif m["range"]:
+            # A range is a single term query whatever its bounds, and * there means unbounded, not a wildcard
+            counts["terms"] += 1
+        elif m["regex"]:
+            counts["regexes"] += 1
+            counts["regexchars"] += len(m["regex"]) - 2
+        elif m["term"] not in BOOLEANS:
+            _, body, fuzzy, _ = split_term(m["term"])
+            counts["terms"] += 1
+            if body[:1] in ("*", "?"):
+                counts["leading"] += 1
+            elif "*" in body or "?" in body:
+                counts["wildcards"] += 1
+            if fuzzy is not None:
+                counts["fuzzy"] += fuzzy_edits(fuzzy)
+    return QueryFeatures(**counts)
+
+
+def query_cost(feats: QueryFeatures):
+    w = COST_WEIGHTS
+    return (feats.terms * w["term"] + feats.wildcards * w["wildcard"] + feats.leading * w["leading"]
+            + feats.regexes * w["regex"] + feats.regexchars * w["regexchar"] + feats.fuzzy * w["fuzzy"]
+            + feats.slop * w["slop"] + feats.depth * w["depth"])
+
+
+def rewrite_query(q: str, limits: dict):
+    """
+    Clamp phrase slop and fuzziness and strip leading wildcards, leaving the rest of the query untouched
+    """
+    def rewrite(m):
+        if m["phrase"] and m["slop"]:
+            return f'{m["field"] or ""}{m["phrase"]}~{min(int(m["slop"]), limits["maxslop"])}'
+        if m["term"] and m["term"] not in BOOLEANS:
+            prefix, body, fuzzy, boost = split_term(m["term"])
+            if not limits["leadingwildcard"]:
+                body = body.lstrip("*?") or body
+            if fuzzy is not None:
+                body = f"{body}~{min(fuzzy_edits(fuzzy), limits['maxfuzzy'])}"
+            return f'{m["field"] or ""}{prefix}{body}{boost}'
+        return m[0]
+    return QUERY_PARTS.sub(rewrite, q)
+
+
+def downgrade_query(q: str):
+    """
+    Escape wildcard, fuzzy and regex syntax so that every term matches literally, keeping boolean structure and phrases
+    """
+    def downgrade(m):
+        if m["regex"] or (m["term"] and m["term"] not in BOOLEANS):
+            return (m["field"] or "") + SPECIAL.sub(r"\\\1", m["regex"] or m["term"])
+        return m[0]
+    return QUERY_PARTS.sub(downgrade, q)
+
+
+def plan_query(q: str, limits: dict):
+    """
+    Estimate the cost of a query_string and decide whether to accept, rewrite, downgrade or reject it
+    """
+    feats = analyze_query(q)
+    cost = query_cost(feats)
+    if feats.terms > limits["maxterms"]:
+        return QueryPlan(q, cost, "reject", f"more than {limits['maxterms']} terms")
+    if feats.depth > limits["maxdepth"]:
+        return QueryPlan(q, cost, "reject", f"nested deeper than {limits['maxdepth']} levels")
+    if cost > limits["reject"]:
+        return QueryPlan(q, cost, "reject", f"estimated cost {cost} exceeds {limits['reject']}")
+    if cost > limits["downgrade"]:
+        return QueryPlan(downgrade_query(q), cost, "downgrade", "wildcard, fuzzy and regex syntax matched literally")
+    rewritten = rewrite_query(q, limits)
+    if rewritten != q:
+        return QueryPlan(rewritten, cost, "rewrite", "leading wildcards, fuzziness or slop reduced")
+    return QueryPlan(q, cost, "accept", "")
+
+
+def cost_headers(plan: QueryPlan):
+    headers = {"x-query-cost": str(plan.cost)}
+    if plan.action != "accept":
+        headers["x-query-action"] = plan.action
+    return headers
+
+
+class QueryGuard:  # pylint: disable=too-few-public-methods
+    """
+    Memoized query plans under fixed limits, rejecting expensive queries before they reach the cache or ES
+    """
+
+    def __init__(self, limits: dict, size: int = 4096):
+        self.limits = limits
+        self.plan = functools.lru_cache(maxsize=size)(self._plan)
+
+    def _plan(self, q: str):
+        return plan_query(q, self.limits)
+
+    @timed("query")
+    def check(self, req: Request, q: str):
+        plan = self.plan(q)
+        # Remembered on the request to report the cost in the response headers
+        req.state.querycost = plan
+        QUERY_ACTIONS.labels(plan.action).inc()
+        if plan.action == "reject":
+            raise HTTPException(status_code=400, detail=f"Query is too expensive: {plan.reason}",
+                                headers=cost_headers(plan))
+        return plan
@@ -0,0 +1,194 @@
+import asyncio
+import random
+import time
+
+from collections import defaultdict, deque
+
+from elasticsearch import AsyncTransport
+from elasticsearch.connection_pool import ConnectionSelector
+from elasticsearch.exceptions import ConnectionError as ESConnectionError, ConnectionTimeout, TransportError
+from elasticsearch._async.http_aiohttp import AIOHttpConnection
+
+from metrics import ES_HEDGES, InstrumentedTransport, es_endpoint
+
+
+# Weight of the latest observation in the per-node moving averages
+EWMA_ALPHA = 0.2
+# Read-only APIs that are safe to send twice, by method since POST /{index}/_doc indexes a document
+HEDGEABLE = {
+    "_search": ("GET", "POST"),
+    "_msearch": ("GET", "POST"),
+    "_count": ("GET", "POST"),
+    "_mget": ("GET", "POST"),
+    "_doc": ("GET",)
+}
+
+
+class TimedConnection(AIOHttpConnection):
+    """
+    ES connection that keeps moving averages of its own latency and error rate
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.latency = None
+        self.error_rate = 0.0
+
+    def observe(self, seconds: float, failed: bool):
+        self.latency = seconds if self.latency is None else (1 - EWMA_ALPHA) * self.latency + EWMA_ALPHA * seconds
+        self.error_rate = (1 - EWMA_ALPHA) * self.error_rate + EWMA_ALPHA * failed
+
+    def score(self):
+        # Errors count as a tenfold slowdown, so a flaky node loses traffic before it is marked dead
+        return (self.latency or 0.0) * (1 + 10 * self.error_rate)
+
+    async def perform_request(self, *args, **kwargs):  # pylint: disable=arguments-differ
+        start = time.perf_counter()
+        failed = True
+        try:
+            res = await super().perform_request(*args, **kwargs)
+            failed = False
+            return res
+        except TransportError as e:
+            failed = not isinstance(e.status_code, int) or e.status_code >= 500
+            raise
+        except asyncio.CancelledError:
+            # A hedged duplicate that lost the race says nothing about this node
+            failed = None
+            raise
+        finally:
+            if failed is not None:
+                self.observe(time.perf_counter() - start, failed)
+
+
+class LatencySelector(ConnectionSelector):  # pylint: disable=too-few-public-methods
+    """
+    Power of two choices over the live connections, preferring the lower latency and error score
+    """
+
+    def select(self, connections):
+        unseen = [c for c in connections if getattr(c, "latency", 0) is None]
+        if unseen:
+            return random.choice(unseen)
+        a, b = random.sample(connections, 2)
+        return a if a.score() <= b.score() else b
+
+
+class HedgingTransport(AsyncTransport):
+    """
+    Sends a duplicate of a slow idempotent read to a second node and keeps whichever response arrives first
+    """
+
+    def __init__(self, *args, hedge_percentile: float = 95, hedge_min_delay: float = 0.02, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_delay = hedge_min_delay
+        self.samples = defaultdict(lambda: deque(maxlen=256))
+
+    def hedge_delay(self, endpoint: str):
+        samples = sorted(self.samples[endpoint])
+        if len(samples) < 20:
+            return None
+        return max(self.hedge_min_delay, samples[int(len(samples) * self.hedge_percentile / 100) - 1])
+
+    def alternate(self, first):
+        others = [c for c in self.connection_pool.connections if c is not first]
+        return min(others, key=lambda c: c.score()) if others else None
+
+    async def perform_request(self, method, url, headers=None, params=None, body=None):
+        endpoint = es_endpoint(url)
+        hedgeable = self.hedge_percentile and method in HEDGEABLE.get(endpoint, ())
+        delay = self.hedge_delay(endpoint) if hedgeable else None
+        if delay is None or self._verified_elasticsearch is not True or len(self.connection_pool.connections) < 2:
+            start = time.perf_counter()
+            res = await super().perform_request(method, url, headers=headers, params=params, body=body)
+            self.samples[endpoint].append(time.perf_counter() - start)
+            return res
+        return await self._hedged(endpoint, delay, method, url, headers, params, body)
+
+    def retryable(self, e: Exception):
+        # The retry rules of the base transport, under which a failed node is also marked dead
+        if not isinstance(e, TransportError):
+            return False
+        if isinstance(e, ConnectionTimeout):
+            return self.retry_on_timeout
+        return isinstance(e, ESConnectionError) or e.status_code in self.retry_on_status
+
+    async def _hedged(self, endpoint, delay, method, url, *args):  # pylint: disable=too-many-arguments,too-many-positional-arguments,too-many-locals
+        headers, params, body = args
+        # Resolving pops request options from the params, which a fallback to the base transport still needs
+        rmethod, rheaders, rparams, rbody, ignore, timeout = self._resolve_request_args(
+            method, dict(headers or {}), dict(params or {}), body)
+        start = time.perf_counter()
+
+        def send(conn):
+            return asyncio.ensure_future(conn.perform_request(rmethod, url, rparams, rbody, headers=rheaders,
+                                                              ignore=ignore, timeout=timeout))
+
+        first = self.get_connection()
+        tasks = {send(first): first}
+        winner = None
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=delay)
+            # Hedge when the first node is slower than usual for this API or could not be reached at all
+            if not done or isinstance(next(iter(done)).exception(), ESConnectionError):
+                second = self.alternate(first)
+                if second:
+                    ES_HEDGES.labels(endpoint, "sent").inc()
+                    tasks[send(second)] = second
+            pending = set(tasks)
+            while pending and not winner:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                winner = next((t for t in done if not t.exception()), None)
+        finally:
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+        for task, conn in tasks.items():
+            if task.done() and not task.cancelled() and self.retryable(task.exception()):
+                self.mark_dead(conn)
+        if not winner:
+            error = next(iter(done)).exception()
+            if not self.retryable(error):
+                raise error
+            # Neither node answered, so the request gets the retries over the remaining nodes it would have had
+            return await super().perform_request(method, url, headers=headers, params=params, body=body)
+        if tasks[winner] is not first:
+            ES_HEDGES.labels(endpoint, "won").inc()
+        self.samples[endpoint].append(time.perf_counter() - start)
+        self.connection_pool.mark_live(tasks[winner])
+        _, headers_response, data = winner.result()
+        if data:
+            ctype = {k.lower(): v for k, v in headers_response.items()}.get("content-type")
+            data = self.deserializer.loads(data, ctype)
+        return data
+
+
+class RoutedTransport(InstrumentedTransport, HedgingTransport):
+    """
+    Instrumented transport over latency-aware node selection and hedged reads
+    """
+
+
+DEFAULT_ROUTING = {
+    "latency": False,
+    "hedgepercentile": 95,
+    "hedgemindelay": 0.02
+}
+
+
+def es_options(routing: dict, maxsize: int, esopts: dict):
+    """
+    Keyword arguments of the ES client, with latency-aware routing when enabled and the configured options on top
+    """
+    if str(routing["latency"]).lower() not in ("true", "1", "t"):
+        return {"transport_class": InstrumentedTransport, "maxsize": maxsize, **esopts}
+    return {
+        "transport_class": RoutedTransport,
+        "connection_class": TimedConnection,
+        "selector_class": LatencySelector,
+        "hedge_percentile": float(routing["hedgepercentile"]),
+        "hedge_min_delay": float(routing["hedgemindelay"]),
+        "maxsize": maxsize,
+        **esopts
+    }
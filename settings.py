@@ -0,0 +1,55 @@
+import os
+
+from admission import DEFAULT_LIMITS as ADMISSION_LIMITS
+from diagnostics import DEFAULT_PROFILING
+from httpcache import DEFAULT_CACHE_CONTROL
+from querycost import DEFAULT_LIMITS
+from routing import DEFAULT_ROUTING
+from utils import load_config, env_to_list, env_to_dict
+
+
+config = load_config()
+config["termfields"] = env_to_list("TERMFIELDS") or config.get("termfields", [])
+config["termaggrs"] = env_to_list("TERMAGGRS") or config.get("termaggrs", [])
+config["indexes"] = env_to_list("INDEXES") or config.get("indexes", [])
+config["eshosts"] = env_to_list("ESHOSTS") or config.get("eshosts", ["http://localhost:9200"])
+config["esopts"] = env_to_dict("ESOPTS") or config.get("esopts", {})
+config["espoolsize"] = int(os.getenv("ESPOOLSIZE", config.get("espoolsize", 10)))
+config["wayback"] = os.getenv("WAYBACK", config.get("wayback", "https://web.archive.org/web")).rstrip("/")
+config["maxpage"] = int(os.getenv("MAXPAGE", config.get("maxpage", 1000)))
+config["mgetchunk"] = int(os.getenv("MGETCHUNK", config.get("mgetchunk", 250)))
+config["maxbuckets"] = int(os.getenv("MAXBUCKETS", config.get("maxbuckets", 1000)))
+config["pitkeepalive"] = os.getenv("PITKEEPALIVE", config.get("pitkeepalive", "2m"))
+config["title"] = os.getenv("TITLE", config.get("title", ""))
+config["description"] = os.getenv("DESCRIPTION", config.get("description", ""))
+config["cachesize"] = int(os.getenv("CACHESIZE", config.get("cachesize", 64 * 1024 * 1024)))
+config["cachettl"] = {
+    "overview": 300,
+    "terms": 900,
+    "dashboard": 300,
+    **(env_to_dict("CACHETTL") or config.get("cachettl", {}))
+}
+config["budgets"] = {
+    "overview": 10,
+    "terms": 5,
+    "dashboard": 15,
+    **{k: float(v) for k, v in (env_to_dict("BUDGETS") or config.get("budgets", {})).items()}
+}
+config["terminateafter"] = {
+    k: int(v) for k, v in (env_to_dict("TERMINATEAFTER") or config.get("terminateafter", {})).items()
+}
+config["querycost"] = {**DEFAULT_LIMITS, **(env_to_dict("QUERYCOST") or config.get("querycost", {}))}
+config["admission"] = {**ADMISSION_LIMITS, **(env_to_dict("ADMISSION") or config.get("admission", {}))}
+config["routing"] = {**DEFAULT_ROUTING, **(env_to_dict("ROUTING") or config.get("routing", {}))}
+config["partitions"] = {
+    "enabled": False,
+    "recent": 1,
+    "ttl": 86400,
+    **(env_to_dict("PARTITIONS") or config.get("partitions", {}))
+}
+config["profiling"] = {**DEFAULT_PROFILING, **(env_to_dict("PROFILING") or config.get("profiling", {}))}
+config["generationttl"] = int(os.getenv("GENERATIONTTL", config.get("generationttl", 30)))
+config["cachecontrol"] = {**DEFAULT_CACHE_CONTROL, **(env_to_dict("CACHECONTROL") or config.get("cachecontrol", {}))}
+config["prefetchsize"] = int(os.getenv("PREFETCHSIZE", config.get("prefetchsize", 32)))
+config["prefetchttl"] = int(os.getenv("PREFETCHTTL", config.get("prefetchttl", 30)))
+config["debug"] = str(os.getenv("DEBUG", config.get("debug", False))).lower() in ("true", "1", "t")
@@ -0,0 +1,109 @@
+import asyncio
+import unittest
+
+from fastapi import HTTPException
+
+from admission import AdmissionController, Gate, Overloaded
+
+
+class GateTest(unittest.IsolatedAsyncioTestCase):
+
+    async def test_queue_full_rejected(self):
+        gate = Gate(1, 1, 5)
+        await gate.acquire()
+        waiter = asyncio.ensure_future(gate.acquire())
+        await asyncio.sleep(0)
+        with self.assertRaises(Overloaded) as ctx:
+            await gate.acquire()
+        self.assertEqual(ctx.exception.status, 429)
+        gate.release()
+        await waiter
+        gate.release()
+        self.assertEqual(gate.active, 0)
+
+    async def test_wait_timeout(self):
+        gate = Gate(1, 1, 0.01)
+        await gate.acquire()
+        with self.assertRaises(Overloaded) as ctx:
+            await gate.acquire()
+        self.assertEqual(ctx.exception.status, 503)
+        self.assertFalse(gate.waiters)
+        gate.release()
+        self.assertEqual(gate.active, 0)
+
+    async def test_slot_handed_over_in_order(self):
+        gate = Gate(1, 4, 5)
+        await gate.acquire()
+        first = asyncio.ensure_future(gate.acquire())
+        second = asyncio.ensure_future(gate.acquire())
+        await asyncio.sleep(0)
+        gate.release()
+        await first
+        self.assertFalse(second.done())
+        self.assertEqual(gate.active, 1)
+        gate.release()
+        await second
+        gate.release()
+        self.assertEqual(gate.active, 0)
+
+    async def test_cancelled_waiter_skipped(self):
+        gate = Gate(1, 4, 5)
+        await gate.acquire()
+        cancelled = asyncio.ensure_future(gate.acquire())
+        waiter = asyncio.ensure_future(gate.acquire())
+        await asyncio.sleep(0)
+        cancelled.cancel()
+        await asyncio.sleep(0)
+        gate.release()
+        await asyncio.wait_for(waiter, 1)
+        gate.release()
+        self.assertEqual((gate.active, len(gate.waiters)), (0, 0))
+
+    async def test_slot_handed_to_cancelled_waiter_passed_on(self):
+        gate = Gate(1, 4, 5)
+        await gate.acquire()
+        cancelled = asyncio.ensure_future(gate.acquire())
+        waiter = asyncio.ensure_future(gate.acquire())
+        await asyncio.sleep(0)
+        # The slot is handed over and the waiter cancelled before it gets to run
+        gate.release()
+        cancelled.cancel()
+        try:
+            await cancelled
+            # Older wait_for returns a result that arrived with the cancellation, the slot is then held
+            gate.release()
+        except asyncio.CancelledError:
+            pass
+        await asyncio.wait_for(waiter, 1)
+        gate.release()
+        self.assertEqual((gate.active, len(gate.waiters)), (0, 0))
+
+
+class AdmissionControllerTest(unittest.IsolatedAsyncioTestCase):
+
+    async def test_collection_override(self):
+        admission = AdmissionController({"paging": {"limit": 3}, "col2/paging": {"limit": 1}}, ["col1", "col2"])
+        self.assertEqual(admission.gate("col1", "paging").limit, 3)
+        self.assertEqual(admission.gate("col2", "paging").limit, 1)
+
+    async def test_rejection_and_release(self):
+        admission = AdmissionController({"export": {"limit": 1, "queue": 0}}, ["col1", "col2"])
+        async with admission.hold(["col2", "col1"], "export"):
+            self.assertFalse(admission.available("col1", "export"))
+            with self.assertRaises(HTTPException) as ctx:
+                async with admission.hold(["col1"], "export"):
+                    pass
+            self.assertEqual(ctx.exception.status_code, 429)
+            self.assertIn("retry-after", ctx.exception.headers)
+        self.assertEqual([admission.gate(c, "export").active for c in ("col1", "col2")], [0, 0])
+        self.assertTrue(admission.available("col1", "export"))
+
+    async def test_unknown_collection_not_gated(self):
+        admission = AdmissionController({}, ["col1"])
+        async with admission.hold(["other"], "paging"):
+            self.assertTrue(admission.available("other", "paging"))
+        self.assertNotIn(("other", "paging"), admission.gates)
+
+
+if __name__ == "__main__":
+    unittest.main()
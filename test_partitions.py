@@ -0,0 +1,113 @@
+import unittest
+
+from datetime import date
+
+from models import Facet, Interval, OverviewQuery
+from partitions import PARTITION_BUCKETS, add_months, closed_span, merge_buckets, merge_partitions, month_parts
+from partitions import month_ranges, part_facetsize, partition_searches
+
+
+def week(day: str, count: int):
+    return {"key_as_string": f"{day}T00:00:00.000Z", "doc_count": count}
+
+
+def term(key: str, count: int):
+    return {"key": key, "doc_count": count}
+
+
+class ClosedSpanTest(unittest.TestCase):
+
+    def test_partial_months_left_out(self):
+        self.assertEqual(closed_span(date(2020, 3, 10), date(2020, 7, 15), 1), (date(2020, 4, 1), date(2020, 7, 1)))
+
+    def test_whole_months_kept(self):
+        self.assertEqual(closed_span(date(2020, 3, 1), date(2020, 7, 31), 1), (date(2020, 3, 1), date(2020, 8, 1)))
+
+    def test_year_boundary(self):
+        self.assertEqual(closed_span(date(2019, 12, 2), date(2020, 1, 31), 1), (date(2020, 1, 1), date(2020, 2, 1)))
+
+    def test_within_a_single_month(self):
+        lo, hi = closed_span(date(2020, 3, 10), date(2020, 3, 20), 1)
+        self.assertGreaterEqual(lo, hi)
+
+    def test_recent_months_left_out(self):
+        lo, hi = closed_span(None, None, 2)
+        self.assertIsNone(lo)
+        self.assertEqual(hi, add_months(date.today(), -2))
+
+
+class MonthRangesTest(unittest.TestCase):
+
+    def test_contiguous_months_collapsed(self):
+        ranges = month_ranges(["2020-01-01", "2020-02-01", "2020-04-01", "2020-12-01", "2021-01-01"])
+        bounds = [(r["range"]["publication_date"]["gte"], r["range"]["publication_date"]["lt"]) for r in ranges]
+        self.assertEqual(bounds, [("2020-01-01", "2020-03-01"), ("2020-04-01", "2020-05-01"),
+                                  ("2020-12-01", "2021-02-01")])
+
+
+class MergeTest(unittest.TestCase):
+
+    def test_straddling_weeks_summed(self):
+        march = [week("2020-03-23", 4), week("2020-03-30", 2)]
+        april = [week("2020-03-30", 5), week("2020-04-06", 7)]
+        self.assertEqual(merge_buckets([march, april], "key_as_string"),
+                         [week("2020-03-23", 4), week("2020-03-30", 7), week("2020-04-06", 7)])
+
+    def test_top_terms_trimmed_after_summing(self):
+        parts = [[term("en", 10), term("fr", 6), term("de", 5)], [term("en", 10), term("es", 6), term("de", 5)]]
+        self.assertEqual(merge_buckets(parts, "key", 2), [term("en", 20), term("de", 10)])
+
+    def test_month_without_matches(self):
+        sres = {"aggregations": {"partitions": {"buckets": [{
+            "key_as_string": "2020-03-01T00:00:00.000Z",
+            "doc_count": 6,
+            "daily": {"buckets": [week("2020-03-30", 6)]},
+            "lang": {"buckets": [term("en", 6)]}
+        }]}}}
+        parts = dict(month_parts(sres, ["2020-03-01", "2020-04-01"]))
+        self.assertEqual(parts["2020-03-01"]["doc_count"], 6)
+        self.assertEqual(parts["2020-03-01"]["daily"], [week("2020-03-30", 6)])
+        self.assertEqual(parts["2020-03-01"]["domain"], [])
+        self.assertEqual(parts["2020-04-01"], {"doc_count": 0, "daily": [], "lang": [], "domain": [], "tld": []})
+
+    def test_partitions_merged_with_live_range(self):
+        payload = OverviewQuery(q="covid", interval=Interval.week, facets=[Facet.daily, Facet.lang], facetsize=1)
+        parts = [
+            {"doc_count": 6, "daily": [week("2020-03-30", 2)], "lang": [term("en", 4), term("fr", 2)]},
+            {"doc_count": 9, "daily": [week("2020-03-30", 5), week("2020-04-06", 4)], "lang": [term("fr", 9)]}
+        ]
+        live = {"hits": {"total": {"value": 3}}, "aggregations": {
+            "daily": {"buckets": [week("2020-04-06", 3)]},
+            "lang": {"buckets": [term("en", 3)]}
+        }}
+        res = merge_partitions(payload, {"partial": False, "live": live}, parts)
+        self.assertEqual(res["hits"]["total"]["value"], 18)
+        self.assertEqual(res["aggregations"]["daily"]["buckets"], [week("2020-03-30", 7), week("2020-04-06", 7)])
+        self.assertEqual(res["aggregations"]["lang"]["buckets"], [term("fr", 11)])
+
+
+class PartitionSearchesTest(unittest.TestCase):
+
+    def test_terms_over_fetched(self):
+        payload = OverviewQuery(q="covid", facetsize=20)
+        searches = partition_searches(payload, None, date(2020, 1, 1), ["2019-11-01", "2019-12-01"])
+        self.assertGreater(part_facetsize(20), 20)
+        live = dict((name, query) for name, query, _ in searches)["live"]
+        self.assertEqual(live["aggregations"]["lang"]["terms"]["size"], part_facetsize(20))
+        _, query, chunk = searches[-1]
+        aggs = query["aggregations"]["partitions"]["aggregations"]
+        self.assertEqual(chunk, ["2019-11-01", "2019-12-01"])
+        self.assertEqual({aggs[f]["terms"]["size"] for f in ("lang", "domain", "tld")}, {part_facetsize(20)})
+
+    def test_chunks_within_bucket_bound(self):
+        payload = OverviewQuery(q="covid", facetsize=100, size=0)
+        months = [date(2000 + i // 12, i % 12 + 1, 1).isoformat() for i in range(240)]
+        chunks = [chunk for name, _, chunk in partition_searches(payload, None, date(2020, 1, 1), months)
+                  if name == "partitions"]
+        self.assertEqual(sum(chunks, []), months)
+        for chunk in chunks:
+            self.assertLessEqual(len(chunk) * (31 + 3 * part_facetsize(100)), PARTITION_BUCKETS)
+
+
+if __name__ == "__main__":
+    unittest.main()
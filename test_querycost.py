@@ -0,0 +1,94 @@
+import unittest
+
+from querycost import DEFAULT_LIMITS, analyze_query, downgrade_query, plan_query, rewrite_query
+
+
+class AnalyzeQueryTest(unittest.TestCase):
+
+    def test_terms_and_booleans(self):
+        feats = analyze_query("covid AND (vaccine OR mask) NOT flu")
+        self.assertEqual(feats.terms, 4)
+        self.assertEqual(feats.depth, 1)
+
+    def test_phrase_and_slop(self):
+        feats = analyze_query('"public health emergency"~5')
+        self.assertEqual(feats.terms, 3)
+        self.assertEqual(feats.slop, 5)
+
+    def test_wildcards(self):
+        feats = analyze_query("vacc* *virus te?t")
+        self.assertEqual(feats.wildcards, 2)
+        self.assertEqual(feats.leading, 1)
+
+    def test_fuzzy(self):
+        self.assertEqual(analyze_query("covid~").fuzzy, 2)
+        self.assertEqual(analyze_query("covid~1 flu~5").fuzzy, 3)
+
+    def test_regex(self):
+        feats = analyze_query("title:/cov.d/")
+        self.assertEqual(feats.regexes, 1)
+        self.assertEqual(feats.regexchars, 5)
+
+    def test_ranges_are_single_terms(self):
+        for q in ("publication_date:[2020-01-01 TO *]", "publication_date:{* TO 2020-01-01]", "[a TO b}"):
+            feats = analyze_query(q)
+            self.assertEqual((feats.terms, feats.wildcards, feats.leading), (1, 0, 0), q)
+
+    def test_range_with_other_terms(self):
+        feats = analyze_query("publication_date:[2020-01-01 TO *] AND covid")
+        self.assertEqual(feats.terms, 2)
+        self.assertEqual(feats.leading, 0)
+
+
+class RewriteQueryTest(unittest.TestCase):
+
+    def test_plain_query_untouched(self):
+        q = 'covid AND "public health" OR title:vaccine^2'
+        self.assertEqual(rewrite_query(q, DEFAULT_LIMITS), q)
+
+    def test_leading_wildcard_stripped(self):
+        self.assertEqual(rewrite_query("*virus AND covid", DEFAULT_LIMITS), "virus AND covid")
+
+    def test_leading_wildcard_allowed(self):
+        limits = {**DEFAULT_LIMITS, "leadingwildcard": True}
+        self.assertEqual(rewrite_query("*virus", limits), "*virus")
+
+    def test_slop_and_fuzziness_clamped(self):
+        self.assertEqual(rewrite_query('"a b"~50', DEFAULT_LIMITS), '"a b"~20')
+        self.assertEqual(rewrite_query("+covid~2^3", DEFAULT_LIMITS), "+covid~1^3")
+
+    def test_ranges_untouched(self):
+        for q in ("publication_date:[2020-01-01 TO *] AND covid", "publication_date:{* TO 2020-01-01}"):
+            self.assertEqual(rewrite_query(q, DEFAULT_LIMITS), q)
+        self.assertEqual(rewrite_query("title:[a TO *] *virus", DEFAULT_LIMITS), "title:[a TO *] virus")
+
+    def test_downgrade_keeps_ranges(self):
+        q = "publication_date:[2020-01-01 TO *] AND cov*d"
+        self.assertEqual(downgrade_query(q), r"publication_date:[2020-01-01 TO *] AND cov\*d")
+
+
+class PlanQueryTest(unittest.TestCase):
+
+    def test_cheap_range_query_accepted(self):
+        plan = plan_query("publication_date:[2020-01-01 TO *] AND covid", DEFAULT_LIMITS)
+        self.assertEqual((plan.action, plan.cost), ("accept", 2))
+
+    def test_leading_wildcard_rewritten(self):
+        plan = plan_query("*virus", DEFAULT_LIMITS)
+        self.assertEqual((plan.action, plan.query), ("rewrite", "virus"))
+
+    def test_expensive_query_downgraded(self):
+        plan = plan_query(" ".join(f"/.*{c}.*/" for c in "abcde"), DEFAULT_LIMITS)
+        self.assertEqual(plan.action, "downgrade")
+
+    def test_too_many_terms_rejected(self):
+        plan = plan_query(" ".join(f"t{i}" for i in range(101)), DEFAULT_LIMITS)
+        self.assertEqual(plan.action, "reject")
+
+    def test_too_deep_rejected(self):
+        plan = plan_query("(" * 11 + "a" + ")" * 11, DEFAULT_LIMITS)
+        self.assertEqual(plan.action, "reject")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,141 @@
+import asyncio
+import unittest
+
+from utils import PrefetchBuffer, ResultCache
+
+
+class Fetch:  # pylint: disable=too-few-public-methods
+    """
+    Factory that counts its calls, returning a value or raising an exception after a delay
+    """
+
+    def __init__(self, value=None, delay: float = 0):
+        self.calls = 0
+        self.value = value
+        self.delay = delay
+
+    async def __call__(self):
+        self.calls += 1
+        await asyncio.sleep(self.delay)
+        if isinstance(self.value, Exception):
+            raise self.value
+        return self.value if self.value is not None else {"calls": self.calls}
+
+
+def complete(res: dict):
+    return not res.get("partial")
+
+
+class ResultCacheTest(unittest.IsolatedAsyncioTestCase):
+
+    async def test_concurrent_misses_coalesced(self):
+        cache = ResultCache(1 << 20)
+        factory = Fetch(delay=0.01)
+        results = await asyncio.gather(*(cache.get_or_set(("k",), 60, factory) for _ in range(5)))
+        self.assertEqual(results, [{"calls": 1}] * 5)
+        self.assertEqual(await cache.get_or_set(("k",), 60, factory), {"calls": 1})
+        self.assertEqual(factory.calls, 1)
+        self.assertEqual({k: cache.stats()[k] for k in ("hits", "misses", "coalesced")},
+                         {"hits": 1, "misses": 1, "coalesced": 4})
+
+    async def test_expired_entries_refetched(self):
+        cache = ResultCache(1 << 20)
+        factory = Fetch()
+        await cache.get_or_set(("k",), 0.01, factory)
+        await asyncio.sleep(0.02)
+        self.assertEqual(await cache.get_or_set(("k",), 0.01, factory), {"calls": 2})
+        self.assertEqual(cache.stats()["expirations"], 1)
+
+    async def test_least_recently_used_evicted(self):
+        cache = ResultCache(40)
+        for key in ("a", "b"):
+            cache.put((key,), 60, "x" * 15)
+        cache.peek(("a",))
+        cache.put(("c",), 60, "x" * 15)
+        self.assertIsNone(cache.peek(("b",)))
+        self.assertIsNotNone(cache.peek(("a",)))
+        self.assertLessEqual(cache.stats()["bytes"], 40)
+        self.assertEqual(cache.stats()["evictions"], 1)
+
+    async def test_oversized_values_not_stored(self):
+        cache = ResultCache(10)
+        cache.put(("k",), 60, "x" * 20)
+        self.assertEqual(cache.stats()["entries"], 0)
+
+    async def test_failures_not_cached(self):
+        cache = ResultCache(1 << 20)
+        factory = Fetch(ValueError("boom"))
+        for _ in range(2):
+            with self.assertRaises(ValueError):
+                await cache.get_or_set(("k",), 60, factory)
+        self.assertEqual((factory.calls, cache.stats()["entries"]), (2, 0))
+
+    async def test_rejected_results_shared_but_not_kept(self):
+        cache = ResultCache(1 << 20)
+        factory = Fetch({"partial": True}, delay=0.01)
+        results = await asyncio.gather(*(cache.get_or_set(("k",), 60, factory, complete) for _ in range(3)))
+        self.assertEqual(results, [{"partial": True}] * 3)
+        self.assertEqual((factory.calls, cache.stats()["entries"]), (1, 0))
+
+    async def test_cancelled_waiter_leaves_fetch_running(self):
+        cache = ResultCache(1 << 20)
+        factory = Fetch(delay=0.01)
+        waiter = asyncio.ensure_future(cache.get_or_set(("k",), 60, factory))
+        await asyncio.sleep(0)
+        waiter.cancel()
+        self.assertEqual(await cache.get_or_set(("k",), 60, factory), {"calls": 1})
+        self.assertEqual(factory.calls, 1)
+
+    async def test_disabled(self):
+        cache = ResultCache(1 << 20)
+        factory = Fetch()
+        await cache.get_or_set(("k",), 0, factory)
+        await cache.get_or_set(("k",), 0, factory)
+        self.assertEqual((factory.calls, cache.stats()["entries"]), (2, 0))
+
+
+class PrefetchBufferTest(unittest.IsolatedAsyncioTestCase):
+
+    async def test_served_once(self):
+        buffer = PrefetchBuffer(4, 60)
+        factory = Fetch()
+        buffer.start(("k",), factory)
+        buffer.start(("k",), factory)
+        self.assertEqual(await buffer.take(("k",)), {"calls": 1})
+        self.assertIsNone(buffer.take(("k",)))
+        self.assertEqual(factory.calls, 1)
+
+    async def test_oldest_cancelled_when_full(self):
+        buffer = PrefetchBuffer(2, 60)
+        for key in ("a", "b", "c"):
+            buffer.start((key,), Fetch(delay=1))
+        self.assertEqual(list(buffer.entries), [("b",), ("c",)])
+        for key in ("b", "c"):
+            buffer.take((key,)).cancel()
+
+    async def test_expired_fetches_cancelled(self):
+        buffer = PrefetchBuffer(4, 0.01)
+        buffer.start(("k",), Fetch(delay=1))
+        task = buffer.entries[("k",)][1]
+        await asyncio.sleep(0.02)
+        self.assertIsNone(buffer.take(("k",)))
+        await asyncio.sleep(0)
+        self.assertTrue(task.cancelled())
+
+    async def test_failure_raised_on_take(self):
+        buffer = PrefetchBuffer(4, 60)
+        buffer.start(("k",), Fetch(ValueError("boom")))
+        await asyncio.sleep(0)
+        with self.assertRaises(ValueError):
+            await buffer.take(("k",))
+
+    async def test_disabled(self):
+        buffer = PrefetchBuffer(0, 60)
+        factory = Fetch()
+        buffer.start(("k",), factory)
+        self.assertIsNone(buffer.take(("k",)))
+        self.assertEqual(factory.calls, 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,13 +1,16 @@
 #!/usr/bin/env python3
 
+import functools
+import io
 import os
 import random
 
-from urllib.parse import quote_plus
+from concurrent.futures import ThreadPoolExecutor
 
 import requests
 
-import matplotlib.pyplot as plt
+from requests.adapters import HTTPAdapter
+
 import altair as alt
 import streamlit as st
 import pandas as pd
@@ -22,6 +25,11 @@ config["indexes"] = env_to_list("INDEXES") or config.get("indexes", [])
 config["title"] = os.getenv("TITLE", config.get("title", "Collection Search API")) + " Explorer"
 config["apiurl"] = os.getenv("APIURL", config.get("apiurl", "http://localhost:8000/v1")).rstrip("/")
 config["maxwc"] = int(os.getenv("MAXWC", config.get("maxwc", 30)))
+config["uicachettl"] = int(os.getenv("UICACHETTL", config.get("uicachettl", 300)))
+config["uicachesize"] = int(os.getenv("UICACHESIZE", config.get("uicachesize", 256)))
+config["wcworkers"] = int(os.getenv("WCWORKERS", config.get("wcworkers", 4)))
+config["wccachesize"] = int(os.getenv("WCCACHESIZE", config.get("wccachesize", 128)))
+config["uipoolsize"] = int(os.getenv("UIPOOLSIZE", config.get("uipoolsize", 20)))
 COLLECTIONS = [c.split(":")[-1] for c in config["indexes"]]
 
 
@@ -29,12 +37,44 @@ st.set_page_config(page_title=config["title"], layout="wide")
 st.title(config["title"])
 
 
-# @st.cache(ttl=300)
-def load_data(cname, qstr, ep="search/overview"):
-    r = requests.get(f"{config['apiurl']}/{cname}/{ep}?q={quote_plus(qstr)}", timeout=60)
-    if r.ok:
-        return r.json()
-    return None
+@st.cache_resource
+def http_session():
+    sess = requests.Session()
+    adapter = HTTPAdapter(pool_connections=config["uipoolsize"], pool_maxsize=config["uipoolsize"])
+    sess.mount("http://", adapter)
+    sess.mount("https://", adapter)
+    return sess
+
+
+@st.cache_data(ttl=config["uicachettl"], max_entries=config["uicachesize"], show_spinner=False)
+def load_data(cname, qstr, ep="search/dashboard"):
+    r = http_session().get(f"{config['apiurl']}/{cname}/{ep}", params={"q": qstr, "interval": "auto"},
+                          timeout=60)
+    if r.status_code == 404:
+        return None
+    r.raise_for_status()
+    return r.json()
+
+
+@st.cache_resource
+def wordcloud_renderer():
+    @functools.lru_cache(maxsize=config["wccachesize"])
+    def render(freqs):
+        wc = WordCloud(background_color="white", random_state=0)
+        wc.generate_from_frequencies(dict(freqs))
+        buf = io.BytesIO()
+        wc.to_image().save(buf, format="PNG")
+        return buf.getvalue()
+    return ThreadPoolExecutor(max_workers=config["wcworkers"]), render
+
+
+def wordcloud_sample(terms, kind, seed):
+    if len(terms) <= config["maxwc"]:
+        return tuple(terms.items())
+    if kind == "rare":
+        # A query-seeded sample keeps the rendered cloud (and its cache entry) stable across reruns
+        return tuple(random.Random(seed).sample(list(terms.items()), config["maxwc"]))
+    return tuple(list(terms.items())[:config["maxwc"]])
 
 
 qp = st.experimental_get_query_params()
@@ -51,10 +91,16 @@ if not q or not col:
 
 st.experimental_set_query_params(**st.session_state)
 
-d = load_data(col, q)
-if not d:
+try:
+    with st.spinner("Searching..."):
+        dash = load_data(col, q)
+except requests.RequestException as e:
+    st.error(f"Search failed: {e}")
+    st.stop()
+if not dash:
     st.warning("No results returned!")
     st.stop()
+d = dash["overview"]
 
 ov = {
     "total": d["total"],
@@ -69,7 +115,7 @@ cols = st.columns(4)
 cols[0].metric("Hits", f"{ov['total']:,}")
 cols[1].metric("Languages", f"{'100+' if len(ov['toplangs'])>=100 else len(ov['toplangs'])}")
 cols[2].metric("Domains", f"{'100+' if len(ov['topdomains'])>=100 else len(ov['topdomains'])}")
-cols[3].metric("Days", f"{len(ov['dailycounts']):,}")
+cols[3].metric(f"Periods ({d.get('interval', '1d')})", f"{len(ov['dailycounts']):,}")
 
 tbs = st.tabs(["Top Hits", "Data"])
 res = ["Title | Domain | Published | Archived | Language", ":---|:---|:---:|:---:|:---:"]
@@ -110,25 +156,22 @@ for i, (k, v) in enumerate(fmap.items()):
         tbs[0].altair_chart(c, use_container_width=True)
         tbs[1].write(ov[v])
 
+pool, render_wordcloud = wordcloud_renderer()
+clouds = {}
+for fld in ["title", "snippet"]:
+    for aggr in ["top", "significant", "rare"]:
+        tt = dash["terms"].get(fld, {}).get(aggr)
+        if tt:
+            clouds[(fld, aggr)] = pool.submit(render_wordcloud, wordcloud_sample(tt, aggr, f"{col}:{q}:{fld}"))
+
 for fld in ["title", "snippet"]:
     cols = st.columns(3)
     for i, aggr in enumerate(["top", "significant", "rare"]):
         with cols[i]:
             tbs = st.tabs([f"{aggr} {fld} terms".title(), "Data"])
-            tt = load_data(col, q, f"terms/{fld}/{aggr}")
+            tt = dash["terms"].get(fld, {}).get(aggr)
             if tt:
-                sample = tt
-                if len(tt) > config["maxwc"]:
-                    if aggr == "rare":
-                        sample = dict(random.sample(list(tt.items()), config["maxwc"]))
-                    else:
-                        sample = dict(list(tt.items())[:config["maxwc"]])
-                wc = WordCloud(background_color="white")
-                wc.generate_from_frequencies(sample)
-                fig, ax = plt.subplots()
-                ax.imshow(wc)
-                ax.axis("off")
-                tbs[0].pyplot(fig)
+                tbs[0].image(clouds[(fld, aggr)].result(), use_container_width=True)
                 tbs[1].write(pd.DataFrame(tt.items(), columns=["Term", "Frequency"]))
             else:
                 tbs[0].info("No related terms found!")
@@ -1,6 +1,11 @@
+import asyncio
+import base64
 import json
 import os
+import re
+import time
 
+from collections import OrderedDict
 from enum import Enum
 
 import yaml
@@ -24,3 +29,138 @@ def env_to_dict(name: str):
 
 def list_to_enum(name: str, koptv: list):
     return Enum(name, [f"{kv}:{kv}".split(":")[:2] for kv in koptv])
+
+
+def encode(strng: str):
+    return base64.b64encode(strng.encode(), b"-_").decode().replace("=", "~")
+
+
+def decode(strng: str):
+    return base64.b64decode(strng.replace("~", "=").encode(), b"-_").decode()
+
+
+def decode_resume(resume: str):
+    token = decode(resume)
+    if token.startswith("{"):
+        return json.loads(token)
+    return {"sort": [token]}
+
+
+QUERY_TOKENS = re.compile(r'"(?:\\.|[^"\\])*"|\S+')
+QUERY_OPERATORS = {"&&": "AND", "||": "OR"}
+
+
+def normalize_query(q: str):
+    """
+    Canonical form of a query_string for cache keys (collapsed whitespace, aliased operators)
+    """
+    return " ".join(QUERY_OPERATORS.get(t, t) for t in QUERY_TOKENS.findall(q))
+
+
+class ResultCache:
+    """
+    Async TTL cache with an approximate memory cap, LRU eviction and coalescing of concurrent misses
+    """
+
+    def __init__(self, maxbytes: int):
+        self.maxbytes = maxbytes
+        self.nbytes = 0
+        self.entries = OrderedDict()
+        self.inflight = {}
+        self.counters = {"hits": 0, "misses": 0, "coalesced": 0, "evictions": 0, "expirations": 0}
+
+    def stats(self):
+        return {**self.counters, "entries": len(self.entries), "bytes": self.nbytes, "maxbytes": self.maxbytes}
+
+    async def get_or_set(self, key: tuple, ttl: float, factory, keep=None):
+        if ttl <= 0 or self.maxbytes <= 0:
+            return await factory()
+        entry = self.entries.get(key)
+        if entry:
+            if entry[0] > time.monotonic():
+                self.entries.move_to_end(key)
+                self.counters["hits"] += 1
+                return entry[2]
+            self._discard(key)
+            self.counters["expirations"] += 1
+        task = self.inflight.get(key)
+        if task:
+            self.counters["coalesced"] += 1
+        else:
+            self.counters["misses"] += 1
+            task = asyncio.ensure_future(factory())
+            self.inflight[key] = task
+            task.add_done_callback(lambda t: self._settle(key, ttl, t, keep))
+        return await asyncio.shield(task)
+
+    def peek(self, key: tuple):
+        entry = self.entries.get(key)
+        if entry and entry[0] > time.monotonic():
+            self.entries.move_to_end(key)
+            self.counters["hits"] += 1
+            return entry[2]
+        self.counters["misses"] += 1
+        return None
+
+    def put(self, key: tuple, ttl: float, value):
+        if ttl > 0 and self.maxbytes > 0:
+            self._store(key, ttl, value)
+
+    def _settle(self, key: tuple, ttl: float, task: asyncio.Task, keep=None):
+        self.inflight.pop(key, None)
+        if task.cancelled() or task.exception():
+            return
+        # Concurrent waiters still share a result that is not worth keeping, e.g. a partial one
+        if keep and not keep(task.result()):
+            return
+        self._store(key, ttl, task.result())
+
+    def _store(self, key: tuple, ttl: float, value):
+        size = len(json.dumps(value, default=str))
+        if size > self.maxbytes:
+            return
+        self._discard(key)
+        self.entries[key] = (time.monotonic() + ttl, size, value)
+        self.nbytes += size
+        while self.nbytes > self.maxbytes:
+            self._discard(next(iter(self.entries)))
+            self.counters["evictions"] += 1
+
+    def _discard(self, key: tuple):
+        entry = self.entries.pop(key, None)
+        if entry:
+            self.nbytes -= entry[1]
+
+
+class PrefetchBuffer:
+    """
+    Bounded buffer of speculatively started fetches, each served at most once before it expires
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict()
+
+    def start(self, key: tuple, factory):
+        if self.maxsize <= 0 or key in self.entries:
+            return
+        self._expire()
+        while len(self.entries) >= self.maxsize:
+            _, oldest = self.entries.popitem(last=False)
+            oldest[1].cancel()
+        task = asyncio.ensure_future(factory())
+        # Failures surface when the entry is taken, not as unretrieved task exceptions
+        task.add_done_callback(lambda t: t.cancelled() or t.exception())
+        self.entries[key] = (time.monotonic() + self.ttl, task)
+
+    def take(self, key: tuple):
+        self._expire()
+        entry = self.entries.pop(key, None)
+        return entry[1] if entry else None
+
+    def _expire(self):
+        now = time.monotonic()
+        while self.entries and next(iter(self.entries.values()))[0] <= now:
+            _, (_, task) = self.entries.popitem(last=False)
+            task.cancel()